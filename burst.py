@@ -1,64 +1,430 @@
 from Box2D import *
 import pyglet
+# Don't create a shadow window, so that the simulation can be imported and
+# run without a display. The game window has its context before any
+# textures are uploaded.
+pyglet.options['shadow_window'] = False
 from pyglet.gl import *
 import rabbyt
+import rabbyt.collisions
 
+from array import array
+from bisect import insort
+from collections import deque
+import hashlib
+from itertools import ifilter, islice
+import json
 from math import *
-from operator import attrgetter
+import multiprocessing
+import os
 import random
+import socket
+import struct
 import sys
+import threading
+import time
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for particles and the vectorized environment.
+    numpy = None
 
 PLAYER_1_GROUP = -1
 PLAYER_2_GROUP = -2
 ASTEROID_GROUP = -3
 
-def create_circle_vertex_list(center=(0., 0.), radius=1., vertex_count=100):
-    x, y = center
-    coords = []
-    for i in xrange(vertex_count):
-        angle = 2. * pi * float(i) / float(vertex_count)
-        coords.append(x + radius * cos(angle))
-        coords.append(y + radius * sin(angle))
-        if i:
-            coords.extend(coords[-2:])
-    coords.extend(coords[:2])
-    return pyglet.graphics.vertex_list(len(coords) // 2, ('v2f', coords))
-
-def debug_draw(world):
-    circle_vertex_list = create_circle_vertex_list()
-    for body in world.bodyList:
-        glPushMatrix()
-        x, y = body.position.tuple()
-        glTranslatef(x, y, 0.)
-        glRotatef(rad_to_deg(body.angle), 0., 0., 1.)
-        for shape in body.shapeList:
-            if isinstance(shape, b2CircleShape):
-                glPushMatrix()
-                x, y = shape.localPosition.tuple()
-                glTranslatef(x, y, 0.)
-                glScalef(shape.radius, shape.radius, shape.radius)
-                circle_vertex_list.draw(GL_LINES)
-                glPopMatrix()
-        glPopMatrix()
+# Collision categories.
+DEFAULT_CATEGORY = 0x0001
+SHIP_CATEGORY = 0x0002
+CANNON_CATEGORY = 0x0004
+SHOT_CATEGORY = 0x0008
+ASTEROID_CATEGORY = 0x0010
+
+# The sprite textures of all things.
+SPRITE_TEXTURES = ['asteroid-ao.png', 'plasma-cannon-ao.png',
+                   'plasma-shot.png', 'ship-1-ao.png', 'ship-2-ao.png']
+
+# All textures that the game uses.
+TEXTURES = SPRITE_TEXTURES + ['stars.png']
+
+class DebugRenderer(object):
+    """Draws physics debug graphics as lines, all in a single call.
+
+    Circle shapes are drawn from a cached unit circle. Joints, contact
+    points from the last step, and the lock-on rays and targets of ships
+    are drawn with the same call, using per-vertex colors instead of GL
+    state changes.
+    """
+
+    shape_color = 0., 1., 0.
+    sleeping_color = 0., 0.5, 0.
+    joint_color = 0.5, 0.5, 1.
+    contact_color = 1., 0., 0.
+    ray_color = 1., 1., 0.
+    target_color = 0., 1., 1.
+
+    def __init__(self, vertex_count=32):
+        # Unit circle as a flat list of line segment end points.
+        self.unit_circle = []
+        for i in xrange(vertex_count):
+            for j in (i, i + 1):
+                angle = 2. * pi * float(j) / float(vertex_count)
+                self.unit_circle.append(cos(angle))
+                self.unit_circle.append(sin(angle))
+        self._circle_colors = {}
+
+    def _add_circle(self, coords, colors, x, y, radius, color):
+        unit_circle = self.unit_circle
+        coords.extend([(x, y)[i & 1] + radius * unit_circle[i]
+                       for i in xrange(len(unit_circle))])
+        circle_colors = self._circle_colors.get(color)
+        if circle_colors is None:
+            circle_colors = color * (len(unit_circle) // 2)
+            self._circle_colors[color] = circle_colors
+        colors.extend(circle_colors)
+
+    def _add_line(self, coords, colors, p1, p2, color):
+        coords.extend((p1[0], p1[1], p2[0], p2[1]))
+        colors.extend(color + color)
+
+    def draw(self, level):
+        coords = []
+        colors = []
+        for body in level.world.bodyList:
+            x, y = body.position.tuple()
+            angle = body.angle
+            co = cos(angle)
+            si = sin(angle)
+            if body.IsSleeping():
+                color = self.sleeping_color
+            else:
+                color = self.shape_color
+            for shape in body.shapeList:
+                if isinstance(shape, b2CircleShape):
+                    local_x, local_y = shape.localPosition.tuple()
+                    self._add_circle(coords, colors,
+                                     x + co * local_x - si * local_y,
+                                     y + si * local_x + co * local_y,
+                                     shape.radius, color)
+        for joint in level.world.jointList:
+            position_1 = joint.GetBody1().position.tuple()
+            position_2 = joint.GetBody2().position.tuple()
+            anchor_1 = joint.GetAnchor1().tuple()
+            anchor_2 = joint.GetAnchor2().tuple()
+            self._add_line(coords, colors, position_1, anchor_1,
+                           self.joint_color)
+            self._add_line(coords, colors, anchor_1, anchor_2,
+                           self.joint_color)
+            self._add_line(coords, colors, position_2, anchor_2,
+                           self.joint_color)
+        for x, y in level.contact_listener.points:
+            self._add_line(coords, colors, (x - 0.2, y - 0.2),
+                           (x + 0.2, y + 0.2), self.contact_color)
+            self._add_line(coords, colors, (x - 0.2, y + 0.2),
+                           (x + 0.2, y - 0.2), self.contact_color)
+        for thing in level.things:
+            if isinstance(thing, Ship):
+                if thing.lock_segment is not None:
+                    p1, p2 = thing.lock_segment
+                    self._add_line(coords, colors, p1, p2, self.ray_color)
+                if thing.target is not None and thing.target.body is not None:
+                    self._add_line(coords, colors, thing.body.position.tuple(),
+                                   thing.target.body.position.tuple(),
+                                   self.target_color)
+        if coords:
+            pyglet.graphics.draw(len(coords) // 2, GL_LINES, ('v2f', coords),
+                                 ('c3f', colors))
 
 def rad_to_deg(angle):
     return angle * 180. / pi
 
-def create_shadow(sprite, texture, x=20, y=-20):
-    """Create a shadow sprite."""
-    return MySprite(texture, scale=sprite.scale, alpha=0.8,
-                    rot=(sprite.attrgetter('rot')),
-                    x=(sprite.attrgetter('x') + x),
-                    y=(sprite.attrgetter('y') + y),
-                    z=(sprite.attrgetter('z') - 0.1))
+def create_shadow(sprite, texture, transforms, handle, x=20, y=-20):
+    """Create a shadow sprite for a sprite connected to a transform."""
+    shadow = MySprite(texture, scale=sprite.scale, alpha=0.8,
+                      z=(sprite.attrgetter('z') - 0.1))
+    transforms.connect(handle, shadow, x, y)
+    return shadow
 
-def create_ao(sprite, texture):
+def create_ao(sprite, texture, transforms, handle):
     """Create an ambient occlusion (AO) sprite."""
-    return create_shadow(sprite, texture, x=0, y=0)
+    return create_shadow(sprite, texture, transforms, handle, x=0, y=0)
 
 class MySprite(rabbyt.Sprite):
     z = rabbyt.anim_slot()
 
+class AssetManager(object):
+    """Loads images, with a cache of decoded pixel data on disk.
+
+    Decoded images are cached as raw RGBA data, keyed by a hash of the
+    source file, so PNGs are only decoded once. Preloading decodes the
+    given files on a background thread. Textures are uploaded on the
+    calling thread, since that is the one with the GL context.
+    """
+
+    magic = 'BRGB'
+    header_format = '<4sII'
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.burst-cache')
+        self.cache_dir = cache_dir
+        self.images = {}
+        self.textures = {}
+        self._events = {}
+        self._errors = {}
+        self._thread = None
+
+    def preload(self, filenames=TEXTURES):
+        """Start decoding images on a background thread."""
+        filenames = [f for f in filenames
+                     if f not in self.images and f not in self._events]
+        for filename in filenames:
+            self._events[filename] = threading.Event()
+        self._thread = threading.Thread(target=self._preload,
+                                        args=(filenames,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _preload(self, filenames):
+        for filename in filenames:
+            try:
+                self.images[filename] = self._load_image(filename)
+            except Exception, e:
+                self._errors[filename] = e
+            self._events[filename].set()
+
+    def get_image(self, filename):
+        """Get decoded image data, waiting for it if it's being preloaded."""
+        image = self.images.get(filename)
+        if image is None:
+            event = self._events.get(filename)
+            if event is None:
+                image = self.images[filename] = self._load_image(filename)
+            else:
+                event.wait()
+                if filename in self._errors:
+                    raise self._errors[filename]
+                image = self.images[filename]
+        return image
+
+    def get_texture(self, filename, mipmapped=False):
+        """Get a texture, uploading it the first time.
+
+        A mipmapped texture is sampled from smaller copies of itself when it
+        is drawn small, if the driver can generate them.
+        """
+        texture = self.textures.get((filename, mipmapped))
+        if texture is None:
+            texture = self.get_image(filename).get_texture()
+            if mipmapped and gl_info.have_extension(
+                    'GL_EXT_framebuffer_object'):
+                glBindTexture(texture.target, texture.id)
+                glTexParameteri(texture.target, GL_TEXTURE_MIN_FILTER,
+                                GL_LINEAR_MIPMAP_LINEAR)
+                glGenerateMipmapEXT(texture.target)
+            self.textures[filename, mipmapped] = texture
+        return texture
+
+    def _load_image(self, filename):
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, digest + '.rgba')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            header_size = struct.calcsize(self.header_format)
+            magic, width, height = struct.unpack(self.header_format,
+                                                 data[:header_size])
+            if magic == self.magic and len(data) == (header_size +
+                                                     4 * width * height):
+                return pyglet.image.ImageData(width, height, 'RGBA',
+                                              data[header_size:])
+        image = pyglet.image.load(filename)
+        data = image.get_data('RGBA', 4 * image.width)
+        self._write_cache(cache_path, image.width, image.height, data)
+        return pyglet.image.ImageData(image.width, image.height, 'RGBA',
+                                      data)
+
+    def _write_cache(self, cache_path, width, height, data):
+        # The cache is only an optimization, so failing to write it is fine.
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(struct.pack(self.header_format, self.magic, width,
+                                    height))
+                f.write(data)
+            os.rename(temp_path, cache_path)
+        except (IOError, OSError):
+            pass
+
+class TextureAtlas(object):
+    """Sprite textures packed into one or a few large textures."""
+
+    def __init__(self, assets, filenames=(), size=1024):
+        self.assets = assets
+        self.texture_bin = pyglet.image.atlas.TextureBin(size, size)
+        self.regions = {}
+        for filename in filenames:
+            self.get_region(filename)
+
+    def get_region(self, filename):
+        region = self.regions.get(filename)
+        if region is None:
+            image = self.assets.get_image(filename)
+            region = self.regions[filename] = self.texture_bin.add(image)
+        return region
+
+class SpriteBatch(object):
+    """Draws a list of sprites with one call per texture.
+
+    The quads are computed the same way as by rabbyt, so the result matches
+    rabbyt.render_unsorted. Sprites that share an atlas texture end up in
+    the same call.
+    """
+
+    def __init__(self):
+        # Shape and texture coordinates of sprites, by texture.
+        self._quads = {}
+
+    def _get_quad(self, sprite):
+        quad = self._quads.get(sprite.texture)
+        if quad is None:
+            shape = [tuple(sprite.shape[i]) for i in xrange(4)]
+            tex_coords = []
+            for i in xrange(4):
+                tex_coords.extend(sprite.tex_shape[i])
+            quad = self._quads[sprite.texture] = shape, tex_coords
+        return quad
+
+    def render(self, sprites):
+        batches = {}
+        for sprite in sprites:
+            batch = batches.get(sprite.texture_id)
+            if batch is None:
+                batch = batches[sprite.texture_id] = [], [], []
+            coords, tex_coords, colors = batch
+            shape, quad_tex_coords = self._get_quad(sprite)
+            x = sprite.x
+            y = sprite.y
+            sx = sprite.scale_x
+            sy = sprite.scale_y
+            angle = sprite.rot * pi / 180.
+            co = cos(angle)
+            si = sin(angle)
+            for vx, vy in shape:
+                vx *= sx
+                vy *= sy
+                coords.append(vx * co - vy * si + x)
+                coords.append(vx * si + vy * co + y)
+            tex_coords.extend(quad_tex_coords)
+            colors.extend(sprite.rgba * 4)
+        glEnable(GL_TEXTURE_2D)
+        for texture_id, (coords, tex_coords, colors) in batches.iteritems():
+            glBindTexture(GL_TEXTURE_2D, texture_id)
+            pyglet.graphics.draw(len(coords) // 2, GL_QUADS, ('v2f', coords),
+                                 ('t2f', tex_coords), ('c4f', colors))
+
+class ParticleSystem(object):
+    """Particles for effects, such as explosions and thrust, in NumPy arrays.
+
+    Positions, velocities, ages, lifetimes and colors are kept in arrays of
+    a fixed capacity, with the live particles first. Particles are updated
+    together in a single pass, and drawn as points in a single call. Dead
+    particles are dropped by moving the live ones to the front, and new
+    particles are dropped while the arrays are full.
+
+    Particles don't affect the simulation, and draw from their own random
+    number generator, so that a level steps the same with or without them.
+    """
+
+    # Fraction of the velocity that is kept after one second.
+    drag = 0.3
+
+    # Size of points, in meters.
+    point_size = 0.15
+
+    def __init__(self, capacity=32768, seed=None):
+        self.capacity = capacity
+        self.count = 0
+        self.random = numpy.random.RandomState(seed)
+        self.positions = numpy.zeros((capacity, 2), numpy.float32)
+        self.velocities = numpy.zeros((capacity, 2), numpy.float32)
+        self.ages = numpy.zeros(capacity, numpy.float32)
+        self.lifetimes = numpy.ones(capacity, numpy.float32)
+        self.colors = numpy.zeros((capacity, 4), numpy.float32)
+
+        # Colors with alpha faded by age, for drawing.
+        self._draw_colors = numpy.zeros((capacity, 4), numpy.float32)
+
+    def __len__(self):
+        return self.count
+
+    def emit(self, position, count, speed, lifetime, color,
+             linear_velocity=(0., 0.), angle=0., spread=(2. * pi)):
+        """Emit particles from a position, in directions spread around an
+        angle, in radians. Speeds and lifetimes vary between half and all of
+        the given ones."""
+        start = self.count
+        count = min(count, self.capacity - start)
+        if count <= 0:
+            return
+        stop = self.count = start + count
+        random_sample = self.random.random_sample
+        angles = angle + spread * (random_sample(count) - 0.5)
+        speeds = speed * (0.5 + 0.5 * random_sample(count))
+        self.positions[start:stop] = position
+        velocities = self.velocities[start:stop]
+        velocities[:, 0] = numpy.cos(angles) * speeds + linear_velocity[0]
+        velocities[:, 1] = numpy.sin(angles) * speeds + linear_velocity[1]
+        self.ages[start:stop] = 0.
+        self.lifetimes[start:stop] = \
+            lifetime * (0.5 + 0.5 * random_sample(count))
+        self.colors[start:stop, :len(color)] = color
+        if len(color) == 3:
+            self.colors[start:stop, 3] = 1.
+
+    def step(self, dt):
+        count = self.count
+        if not count:
+            return
+        ages = self.ages[:count]
+        ages += dt
+        alive = ages < self.lifetimes[:count]
+        if not alive.all():
+            indices = numpy.flatnonzero(alive)
+            count = self.count = len(indices)
+            for values in (self.positions, self.velocities, self.ages,
+                           self.lifetimes, self.colors):
+                values[:count] = values[indices]
+        velocities = self.velocities[:count]
+        velocities *= self.drag ** dt
+        self.positions[:count] += velocities * dt
+
+    def draw(self, pixels_per_meter):
+        count = self.count
+        if not count:
+            return
+        colors = self._draw_colors[:count]
+        colors[:] = self.colors[:count]
+        colors[:, 3] *= 1. - self.ages[:count] / self.lifetimes[:count]
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT | GL_POINT_BIT)
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glDisable(GL_TEXTURE_2D)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE)
+        glPointSize(max(self.point_size * pixels_per_meter, 1.))
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, self.positions.ctypes.data)
+        glColorPointer(4, GL_FLOAT, 0, colors.ctypes.data)
+        glDrawArrays(GL_POINTS, 0, count)
+        glPopClientAttrib()
+        glPopAttrib()
+
 def create_aabb(lower_bound, upper_bound):
     aabb = b2AABB()
     aabb.lowerBound = lower_bound
@@ -67,21 +433,45 @@ def create_aabb(lower_bound, upper_bound):
 
 def create_circle_body(world, position=(0., 0.), linear_velocity=(0., 0.),
                        angle=0., angular_velocity=0., radius=1., density=1.,
-                       group_index=0, sensor=False):
+                       group_index=0, sensor=False,
+                       category_bits=DEFAULT_CATEGORY, mask_bits=0xFFFF):
     body_def = b2BodyDef()
     body_def.position = position
     body_def.angle = angle
     body = world.CreateBody(body_def)
+    create_circle_shape(body, radius=radius, density=density,
+                        group_index=group_index, sensor=sensor,
+                        category_bits=category_bits, mask_bits=mask_bits)
+    body.linearVelocity = linear_velocity
+    body.angularVelocity = angular_velocity
+    return body
+
+def create_circle_shape(body, local_position=(0., 0.), radius=1., density=1.,
+                        group_index=0, sensor=False,
+                        category_bits=DEFAULT_CATEGORY, mask_bits=0xFFFF):
+    """Add a circle shape to a body, update its mass, and return the
+    shape."""
     shape_def = b2CircleDef()
+    shape_def.localPosition = local_position
     shape_def.radius = radius
     shape_def.density = density
     shape_def.filter.groupIndex = group_index
+    shape_def.filter.categoryBits = category_bits
+    shape_def.filter.maskBits = mask_bits
     shape_def.isSensor = sensor
-    body.CreateShape(shape_def)
+    shape = body.CreateShape(shape_def)
     body.SetMassFromShapes()
-    body.linearVelocity = linear_velocity
-    body.angularVelocity = angular_velocity
-    return body
+    return shape
+
+def set_body_filter(body, group_index=0, mask_bits=0xFFFF):
+    """Set the collision filter of every shape of a body."""
+    world = body.GetWorld()
+    for shape in body.shapeList:
+        filter_data = shape.GetFilterData()
+        filter_data.groupIndex = group_index
+        filter_data.maskBits = mask_bits
+        shape.SetFilterData(filter_data)
+        world.Refilter(shape)
 
 def create_prismatic_joint(world, body_1, body_2, anchor=None, axis=None,
                            lower_translation=-1., upper_translation=1.,
@@ -100,11 +490,6 @@ def create_prismatic_joint(world, body_1, body_2, anchor=None, axis=None,
     joint_def.motorSpeed = motor_speed
     world.CreateJoint(joint_def)
 
-def connect_sprite_to_body(sprite, body):
-    sprite.x = lambda: body.position.x
-    sprite.y = lambda: body.position.y
-    sprite.rot = lambda: rad_to_deg(body.angle)
-
 def disconnect_sprite_from_body(sprite, body):
     end_x = body.position.x + body.linearVelocity.x
     end_y = body.position.y + body.linearVelocity.y
@@ -113,6 +498,902 @@ def disconnect_sprite_from_body(sprite, body):
     sprite.y = rabbyt.lerp(end=end_y, dt=1., extend='extrapolate')
     sprite.rot = rabbyt.lerp(end=end_rot, dt=1., extend='extrapolate')
 
+class Profiler(object):
+    """Times the phases of level steps and frames.
+
+    A rolling history of the most recent samples is kept for every phase.
+    Time lapped to a phase more than once between start and stop is summed
+    into a single sample. Laps are tracked per thread, so steps and frames
+    can be timed on different threads, and the samples are only touched
+    under a lock.
+    """
+
+    def __init__(self, phases=(), history=120):
+        self.phases = list(phases)
+        self.history = history
+        self.samples = dict((phase, deque(maxlen=history))
+                            for phase in self.phases)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._local.durations = {}
+        self._local.lap_time = default_timer()
+
+    def lap(self, phase):
+        """Add the time since the previous lap to a phase."""
+        local = self._local
+        lap_time = default_timer()
+        durations = local.durations
+        durations[phase] = (durations.get(phase, 0.) + lap_time -
+                            local.lap_time)
+        local.lap_time = lap_time
+
+    def stop(self):
+        """Record the phase times added since the start."""
+        with self._lock:
+            for phase, duration in self._local.durations.iteritems():
+                if phase not in self.samples:
+                    self.phases.append(phase)
+                    self.samples[phase] = deque(maxlen=self.history)
+                self.samples[phase].append(duration)
+
+    def get_samples(self):
+        """Return a list of every phase with a copy of its samples."""
+        with self._lock:
+            return [(phase, list(self.samples[phase]))
+                    for phase in self.phases]
+
+class FrameGovernor(object):
+    """Trades simulation quality for time when frames run over budget.
+
+    The time spent stepping and drawing is added up for every frame, and
+    smoothed into a load, as a fraction of the frame budget. When the load
+    stays high, quality drops a level: fewer solver iterations, fewer
+    catch-up steps, and less frequent transform updates of sleeping things
+    and things out of view. When the load stays low, quality is restored a
+    level at a time, more slowly than it was dropped.
+    """
+
+    # Quality levels, from full to lowest, of solver iterations, most
+    # catch-up steps in a frame, and steps between transform updates of
+    # sleeping things and things out of view.
+    quality_levels = [(10, 5, 1), (8, 4, 2), (5, 3, 4), (3, 2, 8)]
+
+    # Load above which quality is dropped, and below which it is restored.
+    high_load = 0.8
+    low_load = 0.5
+
+    # Number of frames in a row over or under the load to change quality.
+    drop_frames = 10
+    restore_frames = 120
+
+    # Weight of the latest frame in the smoothed load.
+    smoothing = 0.1
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.quality = 0
+        self.load = 0.
+        self._frame_time = 0.
+        self._over_frames = 0
+        self._under_frames = 0
+
+        # Counters, for tuning.
+        self.frames = 0
+        self.reduced_frames = 0
+        self.drops = 0
+        self.restores = 0
+        self.dropped_steps = 0
+
+    @property
+    def iterations(self):
+        return self.quality_levels[self.quality][0]
+
+    @property
+    def max_steps(self):
+        return self.quality_levels[self.quality][1]
+
+    @property
+    def sync_interval(self):
+        return self.quality_levels[self.quality][2]
+
+    def add_time(self, duration):
+        """Add time spent stepping or drawing to the current frame."""
+        self._frame_time += duration
+
+    def drop_steps(self, count):
+        """Count steps let go because of the catch-up cap."""
+        self.dropped_steps += count
+
+    def end_frame(self):
+        """Update the load with the time of the frame, and decide on the
+        quality of the next one."""
+        load = self._frame_time / self.budget
+        self._frame_time = 0.
+        self.load += self.smoothing * (load - self.load)
+        self.frames += 1
+        if self.quality:
+            self.reduced_frames += 1
+        if self.load > self.high_load:
+            self._over_frames += 1
+            self._under_frames = 0
+        elif self.load < self.low_load:
+            self._under_frames += 1
+            self._over_frames = 0
+        else:
+            self._over_frames = self._under_frames = 0
+        if (self._over_frames >= self.drop_frames and
+                self.quality < len(self.quality_levels) - 1):
+            self.quality += 1
+            self.drops += 1
+            self._over_frames = 0
+        elif self._under_frames >= self.restore_frames and self.quality:
+            self.quality -= 1
+            self.restores += 1
+            self._under_frames = 0
+
+    def get_stats(self):
+        return dict(quality=self.quality, load=self.load,
+                    iterations=self.iterations, max_steps=self.max_steps,
+                    sync_interval=self.sync_interval, frames=self.frames,
+                    reduced_frames=self.reduced_frames, drops=self.drops,
+                    restores=self.restores, dropped_steps=self.dropped_steps)
+
+    def format(self):
+        return ('quality %d/%d  load %3.0f%%  iterations %d  catch-up %d  '
+                'sync 1/%d  drops %d  restores %d  dropped steps %d' %
+                (self.quality, len(self.quality_levels) - 1,
+                 100. * self.load, self.iterations, self.max_steps,
+                 self.sync_interval, self.drops, self.restores,
+                 self.dropped_steps))
+
+class TimingOverlay(object):
+    """Draws phase times, live counts and network counters on top of the
+    screen."""
+
+    font_size = 9
+    row_height = 14
+    graph_x = 320
+
+    def __init__(self, level=None, net_stats=None):
+        self.level = level
+        self.net_stats = net_stats
+        self.visible = False
+        self.labels = {}
+
+    def _get_label(self, key):
+        label = self.labels.get(key)
+        if label is None:
+            label = pyglet.text.Label(font_size=self.font_size)
+            self.labels[key] = label
+        return label
+
+    def draw(self, width, height):
+        y = height - 2 * self.row_height
+        if self.net_stats is not None:
+            label = self._get_label('net')
+            label.text = 'net  ' + self.net_stats.format()
+            label.x, label.y = 10, y
+            label.draw()
+            y -= self.row_height
+        if self.level is not None:
+            self._draw_level(y)
+
+    def _draw_level(self, y):
+        level = self.level
+        profiler = level.profiler
+        budget = level.dt
+
+        # Bars are full height at a quarter of the budget, and turn red when
+        # a sample uses the whole budget.
+        full_scale = 0.25 * budget
+        bar_height = self.row_height - 2
+        coords = []
+        colors = []
+        if level.governor is not None:
+            label = self._get_label('governor')
+            label.text = ('governor  %s  skipped syncs %d' %
+                          (level.governor.format(),
+                           level.transforms.skipped_count))
+            label.x, label.y = 10, y
+            label.draw()
+            y -= self.row_height
+        label = self._get_label('counts')
+        particle_count = 0
+        if level.particles is not None:
+            particle_count = len(level.particles)
+        label.text = ('things %d  bodies %d  contacts %d  sprites %d/%d  '
+                      'particles %d' %
+                      (len(level.things), level.world.GetBodyCount(),
+                       level.world.GetContactCount(),
+                       level.drawn_sprite_count, len(level.sprites),
+                       particle_count))
+        label.x, label.y = 10, y
+        label.draw()
+        for cls, pool in sorted(level.pools.items(),
+                                key=lambda item: item[0].__name__):
+            y -= self.row_height
+            label = self._get_label(cls)
+            label.text = ('%s pool: %d/%d free, %d hits, %d misses, '
+                          '%d discards' % (cls.__name__, len(pool.things),
+                                           pool.size, pool.hits, pool.misses,
+                                           pool.discards))
+            label.x, label.y = 10, y
+            label.draw()
+        for phase, samples in profiler.get_samples():
+            if not samples:
+                continue
+            y -= self.row_height
+            label = self._get_label(phase)
+            label.text = ('%-10s %6.2f ms  mean %6.2f  max %6.2f' %
+                          (phase, 1000. * samples[-1],
+                           1000. * sum(samples) / len(samples),
+                           1000. * max(samples)))
+            label.x, label.y = 10, y
+            label.draw()
+            for i, sample in enumerate(samples):
+                x = float(self.graph_x + 2 * i)
+                fraction = min(sample / full_scale, 1.)
+                coords.extend((x, float(y), x, y + fraction * bar_height))
+                if sample < budget:
+                    colors.extend((0., 1., 0., 0., 1., 0.))
+                else:
+                    colors.extend((1., 0., 0., 1., 0., 0.))
+        if coords:
+            glDisable(GL_TEXTURE_2D)
+            pyglet.graphics.draw(len(coords) // 2, GL_LINES,
+                                 ('v2f', coords), ('c3f', colors))
+            glEnable(GL_TEXTURE_2D)
+
+class Registry(object):
+    """A collection with constant-time insertion and removal.
+
+    Every item is stored in a slot, and its slot index is a handle that
+    stays the same for as long as the item is registered. Removal leaves a
+    hole, so items can be removed during iteration without disturbing it.
+    Holes are reused by later insertions, except while the registry is
+    frozen: then their reuse is deferred until it thaws, and items added
+    in the meantime are appended after every existing slot.
+
+    >>> registry = Registry()
+    >>> registry.add('a'), registry.add('b')
+    (0, 1)
+    >>> registry.remove(0)
+    >>> registry.add('c')
+    0
+    >>> registry.freeze()
+    >>> registry.remove(1)
+    >>> registry.add('d')
+    2
+    >>> registry.thaw()
+    >>> registry.add('e')
+    1
+    >>> list(registry), len(registry)
+    (['c', 'e', 'd'], 3)
+    """
+
+    def __init__(self):
+        self.slots = []
+        self._free_handles = []
+        self._removed_handles = []
+        self._count = 0
+        self._frozen = False
+
+    def add(self, item):
+        """Add an item and return its handle."""
+        if self._free_handles and not self._frozen:
+            handle = self._free_handles.pop()
+            self.slots[handle] = item
+        else:
+            handle = len(self.slots)
+            self.slots.append(item)
+        self._count += 1
+        return handle
+
+    def remove(self, handle):
+        self.slots[handle] = None
+        self._count -= 1
+        if self._frozen:
+            self._removed_handles.append(handle)
+        else:
+            self._free_handles.append(handle)
+
+    def freeze(self):
+        self._frozen = True
+
+    def thaw(self):
+        self._frozen = False
+        self._free_handles.extend(self._removed_handles)
+        del self._removed_handles[:]
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        # Items appended during iteration are not visited.
+        return ifilter(is_registered, islice(self.slots, len(self.slots)))
+
+def is_registered(item):
+    return item is not None
+
+class TimerWheel(object):
+    """Calls functions after delays counted in ticks.
+
+    Timers are kept in a ring of slots, one for every tick, so scheduling
+    and cancelling take constant time, and a tick only visits the timers in
+    its own slot. A timer that is further away than the length of the ring
+    is kept in its slot for another turn. Timers that expire on the same
+    tick are called in the order that they were scheduled. A cancelled
+    timer stays in its slot until its tick comes, and is skipped then.
+
+    Timers are lists of tick, function and arguments, and are their own
+    handles.
+
+    >>> wheel = TimerWheel(size=4)
+    >>> calls = []
+    >>> first = wheel.schedule(2, calls.append, 'first')
+    >>> late = wheel.schedule(6, calls.append, 'late')
+    >>> second = wheel.schedule(2, calls.append, 'second')
+    >>> cancelled = wheel.schedule(1, calls.append, 'cancelled')
+    >>> wheel.cancel(cancelled)
+    >>> len(wheel)
+    3
+    >>> for i in xrange(2):
+    ...     wheel.advance()
+    >>> calls
+    ['first', 'second']
+    >>> wheel.get_remaining(late)
+    4
+    >>> for i in xrange(4):
+    ...     wheel.advance()
+    >>> calls
+    ['first', 'second', 'late']
+    >>> len(wheel)
+    0
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.slots = [[] for i in xrange(size)]
+        self.tick = 0
+        self._count = 0
+
+    def schedule(self, ticks, func, *args):
+        """Call a function after a number of ticks, at least one, and return
+        the handle of the timer."""
+        tick = self.tick + max(ticks, 1)
+        timer = [tick, func, args]
+        self.slots[tick % self.size].append(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer, unless it has already expired."""
+        if timer[1] is not None:
+            timer[1] = timer[2] = None
+            self._count -= 1
+
+    def get_remaining(self, timer):
+        """Return the number of ticks until a timer expires."""
+        return timer[0] - self.tick
+
+    def advance(self):
+        """Move on to the next tick, and call the timers that expire."""
+        self.tick += 1
+        index = self.tick % self.size
+        slot = self.slots[index]
+        if not slot:
+            return
+
+        # Timers scheduled by the calls for a full turn later end up after
+        # the ones that are kept.
+        self.slots[index] = later = []
+        for timer in slot:
+            tick, func, args = timer
+            if func is None:
+                continue
+            if tick > self.tick:
+                later.append(timer)
+            else:
+                timer[1] = timer[2] = None
+                self._count -= 1
+                func(*args)
+
+    def __len__(self):
+        return self._count
+
+class TransformBuffer(object):
+    """Body transforms, copied into arrays of C floats in one pass.
+
+    Every body added gets a handle that indexes the x, y and rotation
+    arrays. Sprites connected to a handle read their transforms straight
+    from the arrays through pointer anims, so drawing doesn't call into
+    Box2D at all. Rotations are kept in degrees, like rabbyt's. When the
+    arrays fill up, they are reallocated and the connected sprites are
+    pointed at the new ones.
+    """
+
+    def __init__(self, capacity=256):
+        self.bodies = Registry()
+        self.connections = {}
+        self._sync_count = 0
+
+        # Number of transforms left alone by throttled syncs.
+        self.skipped_count = 0
+        self.xs = self.ys = self.rots = array('f')
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        old_xs, old_ys, old_rots = self.xs, self.ys, self.rots
+        self.capacity = capacity
+        self.xs = array('f', [0.]) * capacity
+        self.ys = array('f', [0.]) * capacity
+        self.rots = array('f', [0.]) * capacity
+        self.xs[:len(old_xs)] = old_xs
+        self.ys[:len(old_ys)] = old_ys
+        self.rots[:len(old_rots)] = old_rots
+        for handle, sprites in self.connections.iteritems():
+            for sprite, x, y in sprites:
+                self._point(handle, sprite, x, y)
+
+    def _point(self, handle, sprite, x, y):
+        offset = handle * self.xs.itemsize
+        sprite.x = rabbyt.AnimPointer(self.xs.buffer_info()[0] + offset,
+                                      self.xs) + x
+        sprite.y = rabbyt.AnimPointer(self.ys.buffer_info()[0] + offset,
+                                      self.ys) + y
+        sprite.rot = rabbyt.AnimPointer(self.rots.buffer_info()[0] + offset,
+                                        self.rots)
+
+    def add(self, body):
+        """Add a body and return its handle."""
+        handle = self.bodies.add(body)
+        if handle >= self.capacity:
+            self._allocate(2 * self.capacity)
+        position = body.position
+        self.xs[handle] = position.x
+        self.ys[handle] = position.y
+        self.rots[handle] = rad_to_deg(body.angle)
+        return handle
+
+    def remove(self, handle):
+        """Remove a body, leaving its sprites where they are."""
+        for sprite, x, y in self.connections.pop(handle, ()):
+            sprite.xy = sprite.xy
+            sprite.rot = sprite.rot
+        self.bodies.remove(handle)
+
+    def connect(self, handle, sprite, x=0., y=0.):
+        """Make a sprite follow a body, at an offset."""
+        self.connections.setdefault(handle, []).append((sprite, x, y))
+        self._point(handle, sprite, x, y)
+
+    def sync(self, view=None, interval=1):
+        """Copy the transforms of all bodies into the arrays.
+
+        If a view circle of (x, y, radius) is given, bodies that were last
+        seen outside it, and sleeping bodies, are only copied every interval
+        calls, spread over the calls by handle.
+        """
+        if view is None or interval == 1:
+            self._write(self.xs, self.ys, self.rots)
+            return
+        self._sync_count += 1
+        phase = self._sync_count % interval
+        view_x, view_y, view_radius = view
+        squared_radius = view_radius ** 2
+        to_deg = 180. / pi
+        xs, ys, rots = self.xs, self.ys, self.rots
+        skipped = 0
+        for handle, body in enumerate(self.bodies.slots):
+            if body is None:
+                continue
+            if handle % interval != phase:
+                dx = xs[handle] - view_x
+                dy = ys[handle] - view_y
+                if dx * dx + dy * dy > squared_radius or body.IsSleeping():
+                    skipped += 1
+                    continue
+            position = body.position
+            xs[handle] = position.x
+            ys[handle] = position.y
+            rots[handle] = body.angle * to_deg
+        self.skipped_count += skipped
+
+    def _write(self, xs, ys, rots):
+        to_deg = 180. / pi
+        for handle, body in enumerate(self.bodies.slots):
+            if body is not None:
+                position = body.position
+                xs[handle] = position.x
+                ys[handle] = position.y
+                rots[handle] = body.angle * to_deg
+
+    def capture(self):
+        """Return a snapshot of the transforms of all bodies."""
+        xs = array('f', [0.]) * self.capacity
+        ys = array('f', [0.]) * self.capacity
+        rots = array('f', [0.]) * self.capacity
+        self._write(xs, ys, rots)
+        return list(self.bodies.slots), xs, ys, rots
+
+    def interpolate(self, previous, current, alpha):
+        """Fill the arrays with transforms between two snapshots.
+
+        Bodies that have been removed since the current snapshot are left
+        alone, and bodies that are missing from the previous one are placed
+        as in the current one.
+        """
+        previous_bodies, previous_xs, previous_ys, previous_rots = previous
+        bodies, current_xs, current_ys, current_rots = current
+        slots = self.bodies.slots
+        xs, ys, rots = self.xs, self.ys, self.rots
+        previous_count = len(previous_bodies)
+        for handle in xrange(min(len(bodies), len(slots))):
+            body = bodies[handle]
+            if body is None or slots[handle] is not body:
+                continue
+            x = current_xs[handle]
+            y = current_ys[handle]
+            rot = current_rots[handle]
+            if (handle < previous_count and
+                    previous_bodies[handle] is body):
+                x = previous_xs[handle] + alpha * (x - previous_xs[handle])
+                y = previous_ys[handle] + alpha * (y - previous_ys[handle])
+                rot = (previous_rots[handle] +
+                       alpha * (rot - previous_rots[handle]))
+            xs[handle] = x
+            ys[handle] = y
+            rots[handle] = rot
+
+class SpatialGrid(object):
+    """A uniform grid of things, for finding lock-on targets.
+
+    The grid is rebuilt from the current body positions, which are kept
+    with it, so queries don't call into Box2D.
+    """
+
+    def __init__(self, cell_size=10.):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.positions = {}
+
+    def rebuild(self, things):
+        cells = self.cells = {}
+        positions = self.positions = {}
+        inverse_cell_size = 1. / self.cell_size
+        for thing in things:
+            position = thing.body.position
+            x = position.x
+            y = position.y
+            positions[thing] = x, y
+            key = (int(floor(x * inverse_cell_size)),
+                   int(floor(y * inverse_cell_size)))
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [thing]
+            else:
+                cell.append(thing)
+
+    def get_distance(self, thing, x, y):
+        """Return the distance from a point to the edge of a thing."""
+        thing_x, thing_y = self.positions[thing]
+        return hypot(thing_x - x, thing_y - y) - thing.radius
+
+    def query_ray(self, x, y, dx, dy, max_distance, group_index=0):
+        """Return the thing closest to a ray, or None.
+
+        The direction of the ray must be a unit vector. Only things ahead of
+        the origin and within the given distance from it are considered, and
+        things in the given group are skipped, unless it is zero. Ties, such
+        as several things crossed by the ray, go to the nearest thing.
+        """
+        inverse_cell_size = 1. / self.cell_size
+        min_i = int(floor((x - max_distance) * inverse_cell_size))
+        max_i = int(floor((x + max_distance) * inverse_cell_size))
+        min_j = int(floor((y - max_distance) * inverse_cell_size))
+        max_j = int(floor((y + max_distance) * inverse_cell_size))
+        cells = self.cells
+        positions = self.positions
+        best_thing = None
+        best_key = None
+        for i in xrange(min_i, max_i + 1):
+            for j in xrange(min_j, max_j + 1):
+                cell = cells.get((i, j))
+                if cell is None:
+                    continue
+                for thing in cell:
+                    if group_index and thing.group_index == group_index:
+                        continue
+                    thing_x, thing_y = positions[thing]
+                    offset_x = thing_x - x
+                    offset_y = thing_y - y
+                    along = offset_x * dx + offset_y * dy
+                    if along <= 0.:
+                        continue
+                    reach = max_distance + thing.radius
+                    if offset_x ** 2 + offset_y ** 2 >= reach ** 2:
+                        continue
+                    across = abs(offset_x * dy - offset_y * dx) - thing.radius
+                    key = max(across, 0.), along
+                    if best_key is None or key < best_key:
+                        best_thing = thing
+                        best_key = key
+        return best_thing
+
+    def query_nearest(self, x, y, max_distance, group_index=0):
+        """Return the thing whose edge is nearest to a point, within the
+        given distance, or None. Things in the given group are skipped,
+        unless it is zero."""
+        inverse_cell_size = 1. / self.cell_size
+        min_i = int(floor((x - max_distance) * inverse_cell_size))
+        max_i = int(floor((x + max_distance) * inverse_cell_size))
+        min_j = int(floor((y - max_distance) * inverse_cell_size))
+        max_j = int(floor((y + max_distance) * inverse_cell_size))
+        cells = self.cells
+        positions = self.positions
+        best_thing = None
+        best_distance = max_distance
+        for i in xrange(min_i, max_i + 1):
+            for j in xrange(min_j, max_j + 1):
+                cell = cells.get((i, j))
+                if cell is None:
+                    continue
+                for thing in cell:
+                    if group_index and thing.group_index == group_index:
+                        continue
+                    thing_x, thing_y = positions[thing]
+                    distance = (hypot(thing_x - x, thing_y - y) -
+                                thing.radius)
+                    if distance < best_distance:
+                        best_thing = thing
+                        best_distance = distance
+        return best_thing
+
+    def query_segments(self, origins, directions, lengths, group_indices):
+        """Find the first thing along each of a batch of segments.
+
+        Segments are given as NumPy arrays of origins and unit directions,
+        with a row per segment, and arrays of lengths and group indices.
+        Things in the group of a segment are skipped, unless it is zero.
+        The candidates of all segments are gathered from the grid once, and
+        tested against every segment in one pass. Returns a list with the
+        first thing hit, or None, for every segment, and an array of the
+        distances to the hits.
+        """
+        count = len(origins)
+        cells = self.cells
+        if not cells:
+            return [None] * count, numpy.repeat(numpy.inf, count)
+        inverse_cell_size = 1. / self.cell_size
+        ends = origins + directions * lengths[:, numpy.newaxis]
+
+        # Keep the cells that overlap the bounds of any segment. Things may
+        # reach into the cells around their own.
+        lower = numpy.floor(numpy.minimum(origins, ends) *
+                            inverse_cell_size) - 1.
+        upper = numpy.floor(numpy.maximum(origins, ends) *
+                            inverse_cell_size) + 1.
+        keys = cells.keys()
+        indices = numpy.array(keys)[:, numpy.newaxis, :]
+        overlaps = ((indices >= lower) & (indices <= upper)).all(axis=2)
+        candidates = []
+        for key, overlap in zip(keys, overlaps.any(axis=1).tolist()):
+            if overlap:
+                candidates.extend(cells[key])
+        if not candidates:
+            return [None] * count, numpy.repeat(numpy.inf, count)
+        positions = self.positions
+        centers = numpy.array([positions[thing] for thing in candidates])
+        radii = numpy.array([thing.radius for thing in candidates])
+        groups = numpy.array([thing.group_index for thing in candidates])
+
+        # Offsets from every origin to every center, and the distances along
+        # and squared distances across the segments.
+        offsets = centers[numpy.newaxis, :, :] - origins[:, numpy.newaxis, :]
+        along = (offsets * directions[:, numpy.newaxis, :]).sum(axis=2)
+        across_squared = (offsets ** 2).sum(axis=2) - along ** 2
+        chord_squared = radii[numpy.newaxis, :] ** 2 - across_squared
+        half_chords = numpy.sqrt(numpy.maximum(chord_squared, 0.))
+        distances = numpy.maximum(along - half_chords, 0.)
+        segment_groups = group_indices[:, numpy.newaxis]
+        hits = ((chord_squared >= 0.) & (along + half_chords >= 0.) &
+                (distances <= lengths[:, numpy.newaxis]) &
+                ((groups != segment_groups) | (segment_groups == 0)))
+        distances = numpy.where(hits, distances, numpy.inf)
+        nearest = distances.argmin(axis=1)
+        nearest_distances = distances[numpy.arange(count), nearest]
+        things = [candidates[k] if d < numpy.inf else None
+                  for k, d in zip(nearest.tolist(),
+                                  nearest_distances.tolist())]
+        return things, nearest_distances
+
+class SpriteLayers(object):
+    """Sprites kept in layers by z, so that they can be drawn from back to
+    front without sorting every frame.
+
+    Each layer is a list that is handed to rabbyt as is, and the list of
+    depths is only re-sorted when a new depth shows up. A sprite stays in
+    the layer of the z it was added with; use set_z to move it to another
+    one. Removal swaps the last sprite of the layer into the hole, so the
+    draw order of sprites with equal z is not preserved. Sprites are their
+    own handles.
+    """
+
+    def __init__(self):
+        self.depths = []
+        self.layers = {}
+        self._locations = {}
+
+        # The largest bounding radius that has been added to each layer.
+        self.radii = {}
+
+    def add(self, sprite):
+        """Add a sprite and return its handle."""
+        z = sprite.z
+        layer = self.layers.get(z)
+        if layer is None:
+            layer = self.layers[z] = []
+            self.radii[z] = 0.
+            insort(self.depths, z)
+        self.radii[z] = max(self.radii[z], sprite.bounding_radius)
+        self._locations[sprite] = z, len(layer)
+        layer.append(sprite)
+        return sprite
+
+    def remove(self, sprite):
+        z, i = self._locations.pop(sprite)
+        layer = self.layers[z]
+        last_sprite = layer.pop()
+        if last_sprite is not sprite:
+            layer[i] = last_sprite
+            self._locations[last_sprite] = z, i
+
+    def set_z(self, sprite, z):
+        self.remove(sprite)
+        sprite.z = z
+        self.add(sprite)
+
+    def render(self, batch=None, view=None):
+        """Render the layers from back to front, with rabbyt or a batch, and
+        return the number of sprites rendered.
+
+        If a view circle of (x, y, radius) is given, only sprites whose
+        bounding circles overlap it are rendered.
+        """
+        if view is not None:
+            x, y, radius = view
+        count = 0
+        for z in self.depths:
+            layer = self.layers[z]
+            if view is not None and layer:
+                # Rabbyt keeps circles that are closer than the root of the
+                # sum of their squared radii, rather than the sum of their
+                # radii. Widen the view so that it keeps every sprite of the
+                # layer that overlaps it.
+                padded_radius = sqrt(radius * (radius + 2. * self.radii[z]))
+                layer = rabbyt.collisions.collide_single(
+                    (x, y, padded_radius), layer)
+            if layer:
+                if batch is None:
+                    rabbyt.render_unsorted(layer)
+                else:
+                    batch.render(layer)
+                count += len(layer)
+        return count
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __iter__(self):
+        for z in self.depths:
+            for sprite in self.layers[z]:
+                yield sprite
+
+class Pool(object):
+    """Deleted things of a class, kept with their bodies and sprites for
+    reuse.
+
+    Bodies of pooled things are parked at separate spots near the edge of
+    the world, asleep and filtered out of collisions. Things that are
+    deleted while every spot is taken are destroyed as usual.
+    """
+
+    def __init__(self, cls, size, park_positions):
+        self.cls = cls
+        self.size = size
+        self.park_positions = park_positions
+        self.free_spots = range(size - 1, -1, -1)
+        self.things = []
+
+        # Statistics.
+        self.hits = 0
+        self.misses = 0
+        self.discards = 0
+
+    def create(self, level, **kwargs):
+        if self.things:
+            self.hits += 1
+            thing = self.things.pop()
+            self.free_spots.append(thing.pool_spot)
+            thing.pool_spot = None
+            thing.reuse(**kwargs)
+            return thing
+        else:
+            self.misses += 1
+            return self.cls(level=level, **kwargs)
+
+    def park(self, thing):
+        """Park the body of a thing that is being deleted.
+
+        Returns false if there is no room in the pool.
+        """
+        if not self.free_spots:
+            self.discards += 1
+            return False
+        thing.pool_spot = self.free_spots.pop()
+        body = thing.body
+        set_body_filter(body, group_index=thing.group_index, mask_bits=0)
+        body.SetXForm(self.park_positions[thing.pool_spot], 0.)
+        body.linearVelocity = (0., 0.)
+        body.angularVelocity = 0.
+        body.PutToSleep()
+        return True
+
+    def release(self, thing):
+        """Make a parked thing available for reuse."""
+        if thing.pool_sprite is not None:
+            thing.level.sprites.remove(thing.sprite_handle)
+            thing.sprite_handle = None
+        self.things.append(thing)
+
+    def get_stats(self):
+        return dict(size=self.size, free=len(self.things), hits=self.hits,
+                    misses=self.misses, discards=self.discards)
+
+class SimulationThread(threading.Thread):
+    """Steps a level at a fixed rate on its own thread.
+
+    If the thread falls behind, it takes at most max_steps catch-up steps,
+    or as many as the governor of the level allows, and lets the rest of the
+    time go, so that a slow step can't snowball into ever more steps. The
+    level lock is held while stepping.
+    """
+
+    max_steps = 5
+
+    def __init__(self, level):
+        super(SimulationThread, self).__init__()
+        self.daemon = True
+        self.level = level
+        self.stopped = False
+
+    def run(self):
+        level = self.level
+        next_time = default_timer()
+        while not self.stopped:
+            max_steps = self.max_steps
+            if level.governor is not None:
+                max_steps = level.governor.max_steps
+            steps = 0
+            while next_time <= default_timer() and steps < max_steps:
+                with level.lock:
+                    level.step()
+                next_time += level.dt
+                steps += 1
+            now = default_timer()
+            if next_time <= now:
+                if level.governor is not None:
+                    level.governor.drop_steps(int((now - next_time) /
+                                                  level.dt))
+                next_time = now
+            time.sleep(max(next_time - now, 0.))
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+
 class Camera(object):
     def __init__(self):
         # Translation, in meters.
@@ -124,99 +1405,577 @@ class Camera(object):
         # Rotation, in degrees.
         self.angle = 0.
 
+    def get_view(self, width, height):
+        """Return a circle of (x, y, radius), in meters, around what is seen
+        on a screen of the given size, in pixels."""
+        pixels_per_meter = float(min(width, height)) / self.scale
+        radius = 0.5 * hypot(width, height) / pixels_per_meter
+        return self.position.x, self.position.y, radius
+
 class Level(object):
     dt = 1. / 60.
 
-    def __init__(self, debug=False):
+    # Time between challenges, in seconds.
+    challenge_dt = 30.
+
+    def __init__(self, debug=False, headless=False, asteroid_count=10,
+                 pool_sizes=None, atlas=False, assets=None,
+                 interpolated=False, seed=None, particles=None,
+                 governed=False, compound_ships=False, battery='plasma'):
         self.debug = debug
+
+        # All randomness in the level comes from its own generator, so that
+        # a level can be replayed from its seed and the input of its ships.
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.recorder = None
+
+        # Every thing gets a new serial number when it is created or reused,
+        # for matching things to their saved state.
+        self.serial_count = 0
+
+        # Sprites follow the body transforms in a buffer that is synced
+        # after every step. An interpolated level instead captures a
+        # snapshot of the transforms after every step, and places sprites
+        # between the last two when drawn. This is needed when the level is
+        # stepped on another thread.
+        self.transforms = TransformBuffer()
+        self.interpolated = interpolated
+
+        # A governed level lowers its quality when frames run over budget.
+        # Since that depends on the speed of the machine, a governed level
+        # doesn't step the same way every time.
+        self.governor = FrameGovernor(self.dt) if governed else None
+        self.lock = threading.Lock()
+        snapshot = self.transforms.capture()
+        self.transform_snapshots = snapshot, snapshot, default_timer()
+        self.asteroid_count = asteroid_count
+
+        # A headless level has no textures, sprites, or vertex lists, and can
+        # be stepped without a window.
+        self.headless = headless
         self.time = 0.
-        
+
         # Things coordinate bodies and sprites.
-        self.things = []
+        self.things = Registry()
+
+        # The things that do something when stepped.
+        self.stepping_things = Registry()
+
+        # The things that ships can lock on to, and a grid of them that is
+        # rebuilt when a ship is looking for a target.
+        self.targets = Registry()
+        self.target_grid = SpatialGrid()
+        self._target_grid_time = None
 
         # The sprites to draw every frame.
-        self.sprites = []
+        self.sprites = SpriteLayers()
+
+        # Particles are only needed when drawing, and need NumPy.
+        if particles is None:
+            particles = not headless
+        self.particles = None
+        if particles and numpy is not None:
+            self.particles = ParticleSystem(seed=seed)
 
-        self.stars_texture = pyglet.image.load('stars.png')
-        self.stars_texture = pyglet.image.TileableTexture.create_for_image(self.stars_texture)
+        # Pools of deleted things, by class. Pool sizes default to the
+        # pool_size attribute of each class.
+        self.pool_sizes = dict(pool_sizes or {})
+        self.pools = {}
+        self._park_y = -99.
+
+        # Calls scheduled in level time, one tick per step.
+        self.timers = TimerWheel()
+
+        # Step phases are timed every step, and draw phases every frame.
+        self.profiler = Profiler(['timers', 'challenge', 'things',
+                                  'missiles', 'beams', 'target', 'physics',
+                                  'contacts', 'boundary', 'particles',
+                                  'sync', 'stars', 'render', 'effects',
+                                  'debug'])
+
+        self.assets = None
+        self.drawn_sprite_count = 0
+
+        # The circle last seen by the camera, if drawn.
+        self.view = None
+        if not self.headless:
+            self.assets = assets or AssetManager()
+            self.stars_texture = self.assets.get_image('stars.png')
+            self.stars_texture = pyglet.image.TileableTexture.create_for_image(self.stars_texture)
+
+        # With an atlas, sprites are drawn in batches instead of one by one.
+        # Either way, all sprite textures are uploaded up front, so that the
+        # first thing of a kind doesn't cause a hitch.
+        self.atlas = None
+        self.sprite_batch = None
+        if atlas and not self.headless:
+            self.atlas = TextureAtlas(self.assets, SPRITE_TEXTURES)
+            self.sprite_batch = SpriteBatch()
+        elif not self.headless:
+            for filename in SPRITE_TEXTURES:
+                self.assets.get_texture(filename, mipmapped=True)
 
         self._init_world()
-        self._init_circle_vertex_list()
+        if not self.headless:
+            self.debug_renderer = DebugRenderer()
         self.camera = Camera()
 
+        # Player ships have their cannons on their hulls, or jointed to them,
+        # and carry the same battery.
+        self.compound_ships = compound_ships
+        self.battery = battery
+        self.missiles = MissileSwarm(self)
+        self.beams = LaserBeams(self)
         self.player_ships = []
+        self.shots_fired = 0
+        self.asteroids_destroyed = 0
         self.challenge = None
+        self.challenge_timer = None
         self._create_challenge()
-        pyglet.clock.schedule_interval(self._create_challenge, 30.)
 
-    def _create_challenge(self, dt=None):
+    def _create_challenge(self):
         if self.challenge is not None:
             self.challenge.delete()
             self.challenge = None
-        self.challenge = AsteroidField(level=self)
+        self.challenge = AsteroidField(level=self,
+                                       asteroid_count=self.asteroid_count)
+
+        # Challenges are timed in level time rather than wall-clock time, so
+        # that they don't depend on a running pyglet clock.
+        self.challenge_time = self.time
+        self._schedule_challenge(self.challenge_dt)
+
+    def _schedule_challenge(self, delay):
+        if self.challenge_timer is not None:
+            self.cancel_call(self.challenge_timer)
+        self.challenge_timer = self.call_later(delay, self._create_challenge)
+
+    def get_texture(self, filename):
+        """Get a sprite texture, from the atlas if there is one."""
+        if self.atlas is None:
+            return self.assets.get_texture(filename, mipmapped=True)
+        else:
+            return self.atlas.get_region(filename)
+
+    def create(self, cls, **kwargs):
+        """Create a thing, reusing a pooled one if there is any."""
+        pool = self.pools.get(cls)
+        if pool is None:
+            size = self.pool_sizes.get(cls, cls.pool_size)
+            if not size:
+                return cls(level=self, **kwargs)
+            pool = self.pools[cls] = Pool(cls, size,
+                                          self._reserve_park_positions(cls,
+                                                                       size))
+        return pool.create(self, **kwargs)
+
+    def _reserve_park_positions(self, cls, count):
+        # Reserve rows of spots along the bottom of the world, far enough
+        # apart that parked bodies don't overlap.
+        positions = []
+        spacing = cls.park_spacing
+        row_length = int(198. // spacing)
+        for i in xrange(count):
+            if i and not i % row_length:
+                self._park_y += spacing
+            x = -99. + spacing * (0.5 + i % row_length)
+            positions.append((x, self._park_y + 0.5 * spacing))
+        self._park_y += spacing
+        return positions
+
+    def get_ticks(self, delay):
+        """Return the number of steps in a delay, rounded up."""
+        return int(ceil(delay / self.dt - 1e-9))
+
+    def call_later(self, delay, func, *args):
+        """Call a function after a delay in level time, at the start of a
+        step, and return the handle of its timer."""
+        return self.timers.schedule(self.get_ticks(delay), func, *args)
+
+    def cancel_call(self, timer):
+        self.timers.cancel(timer)
+
+    def _capture_transforms(self):
+        snapshot = self.transform_snapshots[1]
+        self.transform_snapshots = (snapshot, self.transforms.capture(),
+                                    default_timer())
+
+    def _interpolate_transforms(self):
+        # Draw one step behind the simulation, between the last two
+        # snapshots.
+        previous_snapshot, snapshot, capture_time = self.transform_snapshots
+        alpha = min(max((default_timer() - capture_time) / self.dt, 0.), 1.)
+        self.transforms.interpolate(previous_snapshot, snapshot, alpha)
+
+    def create_player_ships(self, single=True, ship_class=None):
+        if ship_class is None:
+            ship_class = Ship
+        if single:
+            position_1 = (0., -10.)
+        else:
+            position_1 = (-10., -10.)
+            position_2 = (10., -10.)
+        ship_1 = ship_class(level=self, position=position_1, z=2.,
+                            group_index=PLAYER_1_GROUP,
+                            compound=self.compound_ships,
+                            battery=self.battery)
+        self.player_ships.append(ship_1)
+        if not single:
+            ship_2 = ship_class(texture='ship-2-ao.png', level=self,
+                                position=position_2, z=1.,
+                                group_index=PLAYER_2_GROUP,
+                                compound=self.compound_ships,
+                                battery=self.battery)
+            self.player_ships.append(ship_2)
 
     def _init_world(self):
         aabb = create_aabb((-100., -100.), (100., 100.))
         self.world = b2World(aabb, (0., 0.), True)
         self.contact_listener = MyContactListener()
+        self.contact_handlers = {}
+
+        # Contact points are only needed for debug graphics.
+        self.contact_listener.record_points = self.debug
         self.world.SetContactListener(self.contact_listener)
         self.boundary_listener = MyBoundaryListener()
         self.world.SetBoundaryListener(self.boundary_listener)
 
-    def _init_circle_vertex_list(self):
-        self.circle_vertex_list = create_circle_vertex_list()
-
     def step(self):
+        start_time = default_timer()
+        profiler = self.profiler
+        profiler.start()
+
+        if self.recorder is not None:
+            self.recorder.record()
+
+        # Things deleted during the step don't give up their handles until
+        # the step is over.
+        self.things.freeze()
+        self.stepping_things.freeze()
         self.time += self.dt
+        self.timers.advance()
+        profiler.lap('timers')
         self.challenge.step()
-        for thing in self.things:
+        profiler.lap('challenge')
+        self._update_targets()
+        profiler.lap('target')
+        for thing in self.stepping_things:
             thing.step()
-        self.world.Step(self.dt, 10, 10)
+        profiler.lap('things')
+        self.missiles.step()
+        profiler.lap('missiles')
+        self.beams.resolve()
+        profiler.lap('beams')
+        del self.contact_listener.points[:]
+        iterations = 10
+        if self.governor is not None:
+            iterations = self.governor.iterations
+        self.world.Step(self.dt, iterations, iterations)
+        profiler.lap('physics')
 
-        contacts = list(self.contact_listener.contacts)
-        self.contact_listener.contacts.clear()
+        # A thing deleted by one contact is not told about the rest.
+        contacts = self.contact_listener.pop_contacts()
+        handlers = self.contact_handlers
         for thing_1, thing_2 in contacts:
-            thing_1.collide(thing_2)
-            thing_2.collide(thing_1)
+            if thing_1.deleted or thing_2.deleted:
+                continue
+            key = thing_1.__class__, thing_2.__class__
+            handler = handlers.get(key)
+            if handler is None:
+                handler = handlers[key] = get_contact_handler(*key)
+            handler(thing_1, thing_2)
+        profiler.lap('contacts')
 
-        boundary_violators = list(self.boundary_listener.violators)
-        self.boundary_listener.violators.clear()
+        boundary_violators = self.boundary_listener.violators
+        self.boundary_listener.violators = []
         for thing in boundary_violators:
             thing.delete()
+        self.things.thaw()
+        self.stepping_things.thaw()
+        profiler.lap('boundary')
+        if self.particles is not None:
+            self.particles.step(self.dt)
+            profiler.lap('particles')
+        if self.interpolated:
+            self._capture_transforms()
+        elif self.governor is not None:
+            self.transforms.sync(self.view, self.governor.sync_interval)
+        else:
+            self.transforms.sync()
+        profiler.lap('sync')
+        profiler.stop()
+        if self.governor is not None:
+            self.governor.add_time(default_timer() - start_time)
+
+    def get_digest(self):
+        """Return a hash of the time and the state of all bodies, for telling
+        whether two runs ended up the same.
+
+        Parked bodies are left out, since how full the pools are has no
+        effect on the game.
+        """
+        digest = hashlib.sha1(struct.pack('<d', self.time))
+        for body in self.world.bodyList:
+            thing = body.userData
+            if thing is not None and thing.deleted:
+                continue
+            position = body.position
+            linear_velocity = body.linearVelocity
+            digest.update(struct.pack('<6d', position.x, position.y,
+                                      body.angle, linear_velocity.x,
+                                      linear_velocity.y,
+                                      body.angularVelocity))
+        return digest.digest()
+
+    def save_snapshot(self):
+        """Save the state of the level to a string.
+
+        The state of the player ships, and of the things of the types in
+        SNAPSHOT_TYPES, is saved as an array of doubles, along with the time
+        and the state of the random number generator.
+
+        Restoring is approximate. Box2D keeps contact and joint impulses
+        from step to step, and they are not saved, so a level that is rolled
+        back drifts from the original run within a few dozen steps. Replays
+        start over from the seed instead.
+        """
+        data = array('d', (self.time, self.challenge_time, self.serial_count))
+        version, internal_state, gauss_next = self.random.getstate()
+        data.append(version)
+        data.append(len(internal_state))
+        data.extend(internal_state)
+        data.extend((gauss_next is not None, gauss_next or 0.))
+        things = list(self.player_ships)
+        data.append(len(self.player_ships))
+        for ship in self.player_ships:
+            data.append(not ship.deleted)
+            if not ship.deleted:
+                ship.save_state(data)
+        other_things = [t for t in self.things
+                        if t.__class__ in SNAPSHOT_TYPES]
+        things.extend(other_things)
+        data.append(len(other_things))
+        for thing in other_things:
+            data.extend((SNAPSHOT_TYPES.index(thing.__class__),
+                         thing.serial))
+            thing.save(data)
+        indices = dict((thing, i) for i, thing in enumerate(things))
+        for ship in self.player_ships:
+            data.append(indices.get(ship.target, -1))
+        return data.tostring()
+
+    def load_snapshot(self, snapshot):
+        """Restore the state of the level from a saved snapshot.
+
+        Things that still exist are updated in place. Other things are
+        created, and things that didn't exist when the snapshot was saved
+        are deleted.
+        """
+        data = array('d')
+        data.fromstring(snapshot)
+        self.time, self.challenge_time = data[0], data[1]
+        self._schedule_challenge(self.challenge_time + self.challenge_dt -
+                                 self.time)
+        self.serial_count = max(self.serial_count, int(data[2]))
+        version = int(data[3])
+        size = int(data[4])
+        internal_state = tuple(int(value) for value in data[5:5 + size])
+        i = 5 + size
+        gauss_next = data[i + 1] if data[i] else None
+        i += 2
+        ship_count = int(data[i])
+        i += 1
+        for j in xrange(ship_count):
+            alive = data[i]
+            i += 1
+            ship = self.player_ships[j]
+            if alive:
+                if ship.deleted:
+                    ship = ship.__class__(level=self, texture=ship.texture,
+                                          z=ship.z,
+                                          group_index=ship.group_index,
+                                          compound=ship.compound,
+                                          battery=ship.battery)
+                    self.player_ships[j] = ship
+                i = ship.load_state(data, i)
+            elif not ship.deleted:
+                ship.delete()
+        things = list(self.player_ships)
+        old_things = dict((t.serial, t) for t in self.things
+                          if t.__class__ in SNAPSHOT_TYPES)
+        thing_count = int(data[i])
+        i += 1
+        for j in xrange(thing_count):
+            cls = SNAPSHOT_TYPES[int(data[i])]
+            serial = int(data[i + 1])
+            thing = old_things.pop(serial, None)
+            if thing is not None and thing.__class__ is not cls:
+                old_things[serial] = thing
+                thing = None
+            thing, i = cls.load(self, data, i + 2, thing)
+            thing.serial = serial
+            things.append(thing)
+        for thing in old_things.itervalues():
+            thing.delete()
+        for ship in self.player_ships:
+            target_index = int(data[i])
+            i += 1
+            ship.target = things[target_index] if target_index >= 0 else None
+        if isinstance(self.challenge, AsteroidField):
+            self.challenge.asteroids = [t for t in things
+                                        if isinstance(t, Asteroid)]
+
+        # Restore the generator last, since creating things may draw from
+        # it.
+        self.random.setstate((version, internal_state, gauss_next))
+        self.contact_listener.pop_contacts()
+        self.boundary_listener.violators = []
+        self.transforms.sync()
+
+        # The grid holds the things from before the restore.
+        self._target_grid_time = None
+
+    def get_target_grid(self):
+        """Return the grid of targets, rebuilt at most once a step."""
+        if self._target_grid_time != self.time:
+            self.target_grid.rebuild(self.targets)
+            self._target_grid_time = self.time
+        return self.target_grid
+
+    def _update_targets(self):
+        # Answer the lock-on queries of all ships from a single grid.
+        ships = [s for s in self.player_ships if not s.deleted]
+        for ship in ships:
+            ship.lock_segment = None
+            if not ship.locking:
+                ship.target = None
+        ships = [s for s in ships if s.locking]
+        if not ships:
+            return
+        grid = self.get_target_grid()
+        for ship in ships:
+            position = ship.body.position
+            x = position.x
+            y = position.y
+            target = ship.target
+            if target is not None:
+                if (target.deleted or
+                        grid.get_distance(target, x, y) >= ship.lock_range):
+                    ship.target = None
+            if ship.target is None:
+                direction = ship.body.GetWorldVector(b2Vec2(0., 1.))
+                ship.target = grid.query_ray(x, y, direction.x, direction.y,
+                                             ship.lock_range,
+                                             group_index=ship.group_index)
+                ship.lock_segment = ((x, y),
+                                     (x + ship.lock_range * direction.x,
+                                      y + ship.lock_range * direction.y))
 
     def draw(self, width, height):
+        start_time = default_timer()
+        profiler = self.profiler
+        profiler.start()
         glColor3f(1., 1., 1.)
         self.stars_texture.blit_tiled(0, 0, 0, width, height)
+        profiler.lap('stars')
         glPushMatrix()
         glTranslatef(float(width // 2), float(height // 2), 0.)
         scale = float(min(width, height)) / self.camera.scale
         glScalef(scale, scale, scale)
+        glTranslatef(-self.camera.position.x, -self.camera.position.y, 0.)
         rabbyt.set_time(self.time)
-        self.sprites.sort(key=attrgetter('z'))
-        rabbyt.render_unsorted(self.sprites)
+
+        # Only draw the sprites in view. A level that is stepped on another
+        # thread adds and removes sprites while stepping, so render under
+        # the lock.
+        view = self.view = self.camera.get_view(width, height)
+        with self.lock:
+            if self.interpolated:
+                self._interpolate_transforms()
+            self.drawn_sprite_count = self.sprites.render(self.sprite_batch,
+                                                          view=view)
+        profiler.lap('render')
+        with self.lock:
+            self.beams.draw()
+            if self.particles is not None:
+                self.particles.draw(scale)
+        profiler.lap('effects')
         if self.debug:
-            glColor3f(0., 1., 0.)
             glDisable(GL_TEXTURE_2D)
-            debug_draw(self.world)
+            with self.lock:
+                self.debug_renderer.draw(self)
+            profiler.lap('debug')
         glPopMatrix()
+        profiler.stop()
+        if self.governor is not None:
+            self.governor.add_time(default_timer() - start_time)
+            self.governor.end_frame()
 
 class MyContactListener(b2ContactListener):
+    """Collects the pairs of things in contact that need to be told.
+
+    A pair is only kept if either thing has the category of the other in
+    its collide mask, and each pair is kept once, however many contact
+    points it has. Pairs are kept in the order that Box2D reports them, so
+    that stepping is deterministic.
+    """
+
     def __init__(self):
         super(MyContactListener, self).__init__()
-        self.contacts = set()
+        self.contacts = []
+        self._pairs = set()
+        self.record_points = False
+        self.points = []
 
     def Add(self, point):
-        thing_1 = point.shape1.GetBody().userData
-        thing_2 = point.shape2.GetBody().userData
-        self.contacts.add((thing_1, thing_2))
+        thing_1 = point.shape1.userData
+        thing_2 = point.shape2.userData
+        if (thing_1.collide_mask & thing_2.category or
+                thing_2.collide_mask & thing_1.category):
+            pair = thing_1, thing_2
+            if pair not in self._pairs:
+                self._pairs.add(pair)
+                self.contacts.append(pair)
+        if self.record_points:
+            self.points.append(point.position.tuple())
+
+    def pop_contacts(self):
+        """Return the pairs collected since the last call."""
+        contacts = self.contacts
+        self.contacts = []
+        self._pairs.clear()
+        return contacts
+
+def collide_both(thing_1, thing_2):
+    thing_1.collide(thing_2)
+    thing_2.collide(thing_1)
+
+def collide_first(thing_1, thing_2):
+    thing_1.collide(thing_2)
+
+def collide_second(thing_1, thing_2):
+    thing_2.collide(thing_1)
+
+def get_contact_handler(cls_1, cls_2):
+    """Return a function that tells two things of the given types about their
+    contact, according to their collide masks."""
+    if cls_1.collide_mask & cls_2.category:
+        if cls_2.collide_mask & cls_1.category:
+            return collide_both
+        return collide_first
+    return collide_second
 
 class MyBoundaryListener(b2BoundaryListener):
     def __init__(self):
         super(MyBoundaryListener, self).__init__()
-        self.violators = set()
+        self.violators = []
 
     def Violation(self, body):
-        self.violators.add(body.userData)
+        if body.userData not in self.violators:
+            self.violators.append(body.userData)
 
 class Thing(object):
     """A physical, visible thing.
@@ -224,8 +1983,8 @@ class Thing(object):
     Things have a circular physics body and a sprite that moves and rotates
     with the body.
 
-    For non-physical stuff, such as pure special effects, use sprites directly
-    instead.
+    For non-physical stuff, such as pure special effects, use sprites or the
+    particles of the level instead.
     """
 
     radius = 1.
@@ -236,16 +1995,35 @@ class Thing(object):
     sensor = False
     group_index = 0
 
+    # The collision category of the thing, the categories that it collides
+    # with, and the categories of the things that collide is called for.
+    category = DEFAULT_CATEGORY
+    mask_bits = 0xFFFF
+    collide_mask = 0
+
+    # Whether ships can lock on to the thing.
+    targetable = False
+
+    # Number of deleted things to keep for reuse, and the distance between
+    # their parked bodies.
+    pool_size = 0
+    park_spacing = 1.
+
     def __init__(self, level, position=(0., 0.), linear_velocity=(0., 0.),
                  angle=0., angular_velocity=0., z=0., group_index=0,
                  red=1., green=1., blue=1.):
         self.group_index = group_index
         self.deleted = False
         self.level = level
+        self.z = z
+        self.color = red, green, blue
+        self.pool_spot = None
+        self.pool_body = None
+        self.pool_sprite = None
         self._init_body(position=position, linear_velocity=linear_velocity,
                         angle=angle, angular_velocity=angular_velocity)
         self._init_sprite(z=z, red=red, green=green, blue=blue)
-        self.level.things.append(self)
+        self._register()
 
     def _init_body(self, position=(0., 0.), linear_velocity=(0., 0.),
                    angle=0., angular_velocity=0.):
@@ -257,27 +2035,151 @@ class Thing(object):
                                        radius=self.radius,
                                        density=self.density,
                                        group_index=self.group_index,
-                                       sensor=self.sensor)
+                                       sensor=self.sensor,
+                                       category_bits=self.category,
+                                       mask_bits=self.mask_bits)
         self.body.userData = self
+        for shape in self.body.shapeList:
+            shape.userData = self
 
     def _init_sprite(self, z=0., red=1., green=1., blue=1.):
-        self.sprite = MySprite(texture=self.texture, scale=self.scale,
+        if self.level.headless:
+            self.sprite = None
+            self.sprite_handle = None
+            self.transform_handle = None
+            return
+        texture = self.level.get_texture(self.texture)
+        self.sprite = MySprite(texture=texture, scale=self.scale,
                                red=red, green=green, blue=blue, alpha=0., z=z)
-        connect_sprite_to_body(self.sprite, self.body)
+        self._connect_sprite()
         self.fade_in()
-        self.level.sprites.append(self.sprite)
+        self.sprite_handle = self.level.sprites.add(self.sprite)
+
+    def _connect_sprite(self):
+        self.transform_handle = self.level.transforms.add(self.body)
+        self.level.transforms.connect(self.transform_handle, self.sprite)
+
+    def _disconnect_sprite(self):
+        self.level.transforms.remove(self.transform_handle)
+        self.transform_handle = None
+        disconnect_sprite_from_body(self.sprite, self.body)
+
+    def _register(self):
+        self.level.serial_count += 1
+        self.serial = self.level.serial_count
+        self.handle = self.level.things.add(self)
+        if self.targetable:
+            self.target_handle = self.level.targets.add(self)
+
+        # Only things that override step are stepped.
+        if self.__class__.step.im_func is not Thing.step.im_func:
+            self.stepping_handle = self.level.stepping_things.add(self)
+        else:
+            self.stepping_handle = None
+
+    def _unregister(self):
+        self.level.things.remove(self.handle)
+        self.handle = None
+        if self.targetable:
+            self.level.targets.remove(self.target_handle)
+            self.target_handle = None
+        if self.stepping_handle is not None:
+            self.level.stepping_things.remove(self.stepping_handle)
+            self.stepping_handle = None
+
+    def reuse(self, position=(0., 0.), linear_velocity=(0., 0.), angle=0.,
+              angular_velocity=0., z=0., group_index=0, red=1., green=1.,
+              blue=1.):
+        """Bring a pooled thing back, as if it had just been created."""
+        self.group_index = group_index
+        self.deleted = False
+        self.z = z
+        self.color = red, green, blue
+        self.body = self.pool_body
+        self.pool_body = None
+        self.body.SetXForm(position, angle)
+        self.body.linearVelocity = linear_velocity
+        self.body.angularVelocity = angular_velocity
+        set_body_filter(self.body, group_index=group_index,
+                        mask_bits=self.mask_bits)
+        self.body.WakeUp()
+        if self.pool_sprite is not None:
+            self.sprite = self.pool_sprite
+            self.pool_sprite = None
+            self.sprite.z = z
+            self.sprite.red = red
+            self.sprite.green = green
+            self.sprite.blue = blue
+            self._connect_sprite()
+            self.fade_in()
+            self.sprite_handle = self.level.sprites.add(self.sprite)
+        self._register()
 
     def delete(self):
         if not self.deleted:
             self.deleted = True
-            self.level.things.remove(self)
-            self.fade_away()
-            self.level.world.DestroyBody(self.body)
+            self._unregister()
+
+            # Fade the sprite out from the live transform, before the body
+            # is parked or destroyed.
+            if self.sprite is not None:
+                self.fade_out()
+                self._disconnect_sprite()
+            pool = self.level.pools.get(self.__class__)
+            if pool is not None and pool.park(self):
+                # Keep the sprite until it has faded out, then give the
+                # thing back to the pool.
+                self.pool_sprite = self.sprite
+                self.sprite = None
+                self.pool_body = self.body
+                self.level.call_later(self.fade_dt, pool.release, self)
+            else:
+                if self.sprite is not None:
+                    self.level.call_later(self.fade_dt,
+                                          self.level.sprites.remove,
+                                          self.sprite_handle)
+                    self.sprite = None
+                    self.sprite_handle = None
+                self.level.world.DestroyBody(self.body)
             self.body = None
 
     def step(self):
         pass
 
+    def save(self, data):
+        """Append the state of the thing to an array of doubles, including
+        what is needed to create it."""
+        data.extend((self.group_index, self.z))
+        self.save_state(data)
+
+    @classmethod
+    def load(cls, level, data, i, thing=None, **kwargs):
+        """Load a thing saved at an index of an array, creating it unless it
+        is given. Returns the thing and the index after its state."""
+        if thing is None:
+            thing = cls(level=level, group_index=int(data[i]), z=data[i + 1],
+                        **kwargs)
+        return thing, thing.load_state(data, i + 2)
+
+    def save_state(self, data):
+        """Append the state of the thing to an array of doubles."""
+        position = self.body.position
+        linear_velocity = self.body.linearVelocity
+        data.extend((position.x, position.y, self.body.angle,
+                     linear_velocity.x, linear_velocity.y,
+                     self.body.angularVelocity))
+
+    def load_state(self, data, i):
+        """Load the state saved at an index of an array, and return the
+        index after it."""
+        x, y, angle, linear_velocity_x, linear_velocity_y, angular_velocity = \
+            data[i:i + 6]
+        self.body.SetXForm((x, y), angle)
+        self.body.linearVelocity = linear_velocity_x, linear_velocity_y
+        self.body.angularVelocity = angular_velocity
+        self.body.WakeUp()
+        return i + 6
+
     def fade_in(self):
         dt = self.fade_dt * (1. - self.sprite.alpha)
         self.sprite.alpha = rabbyt.lerp(end=1., dt=dt)
@@ -286,14 +2188,6 @@ class Thing(object):
         dt = self.fade_dt * self.sprite.alpha
         self.sprite.alpha = rabbyt.lerp(end=0., dt=self.fade_dt)
 
-    def fade_away(self):
-        self.fade_out()
-        disconnect_sprite_from_body(self.sprite, self.body)
-        def remove_sprite(dt, sprite):
-           self.level.sprites.remove(sprite)
-        pyglet.clock.schedule_once(remove_sprite, self.fade_dt, self.sprite)
-        self.sprite = None
-
     def collide(self, other):
         pass
 
@@ -306,111 +2200,672 @@ class Challenge(object):
         pass
 
     def step(self):
-        pass
+        pass
+
+class AsteroidField(Challenge):
+    """The player must navigate through an asteroid field."""
+
+    def __init__(self, asteroid_count=10, **kwargs):
+        super(AsteroidField, self).__init__(**kwargs)
+        self.asteroid_count = asteroid_count
+        self.asteroids = []
+
+    def delete(self):
+        for asteroid in self.asteroids:
+            asteroid.delete()
+        self.asteroids = []
+
+    def step(self):
+        self.asteroids = [a for a in self.asteroids if not a.deleted]
+        targets = [s for s in self.level.player_ships if not s.deleted]
+        if targets:
+            while len(self.asteroids) < self.asteroid_count:
+                target = self.level.random.choice(targets)
+                asteroid = self.create_asteroid(target)
+                self.asteroids.append(asteroid)
+
+    def create_asteroid(self, target):
+        position_angle = 2 * pi * self.level.random.random()
+        distance = self.level.random.gauss(50., 1.)
+        position = (self.level.camera.position +
+                    distance * b2Vec2(cos(position_angle),
+                                      sin(position_angle)))
+        linear_velocity = target.body.position - position
+        linear_velocity.Normalize()
+        linear_velocity *= self.level.random.gauss(5., 1.)
+        orientation_angle = 2 * pi * self.level.random.random()
+        angular_velocity = self.level.random.gauss(0., 0.5)
+        asteroid = self.level.create(Asteroid, position=position,
+                                     linear_velocity=linear_velocity,
+                                     angle=orientation_angle,
+                                     angular_velocity=angular_velocity)
+        return asteroid
+
+class Reloader(object):
+    """Mixin for cannons that fire as soon as they are loaded, and reload
+    after a random cooldown.
+
+    The cooldown is that of the cannon class in the weapon attribute, and
+    shots are fired by calling fire.
+    """
+
+    def _init_reloader(self):
+        self.firing = False
+        self.loaded = True
+        self.reload_timer = None
+
+    def reload(self):
+        self.loaded = True
+        self.reload_timer = None
+
+    def _step_reloader(self):
+        if self.firing and self.loaded:
+            # Spread the cooldown, so that the cannons are only synchronized
+            # for the very first shots after a cease fire.
+            cooldown = self.level.random.gauss(self.weapon.cooldown_mean,
+                                               self.weapon.cooldown_dev)
+            self.loaded = False
+            self.reload_timer = self.level.call_later(cooldown, self.reload)
+            self.fire()
+
+    def _save_reloader(self, data):
+        reload_ticks = 0
+        if self.reload_timer is not None:
+            reload_ticks = self.level.timers.get_remaining(self.reload_timer)
+        data.extend((reload_ticks, self.firing))
+
+    def _load_reloader(self, data, i):
+        if self.reload_timer is not None:
+            self.level.cancel_call(self.reload_timer)
+            self.reload_timer = None
+        reload_ticks = int(data[i])
+        self.loaded = not reload_ticks
+        if reload_ticks:
+            self.reload_timer = self.level.timers.schedule(reload_ticks,
+                                                           self.reload)
+        self.firing = bool(data[i + 1])
+        return i + 2
+
+class Cannon(Reloader, Thing):
+    """A cannon, jointed to the hull of a ship.
+
+    A firing cannon fires as soon as it is loaded, and reloads after a
+    random cooldown. Subclasses launch their shots from the muzzle.
+    """
+
+    radius = 0.1
+    category = CANNON_CATEGORY
+    texture = 'plasma-cannon-ao.png'
+    scale = 0.015
+    tint = 1., 1., 1.
+    recoil = 1.5
+    cooldown_mean = 0.3
+    cooldown_dev = 0.05
+
+    def __init__(self, ship, **kwargs):
+        red, green, blue = self.tint
+        super(Cannon, self).__init__(group_index=ship.group_index, red=red,
+                                     green=green, blue=blue, **kwargs)
+        self.ship = ship
+
+        # A cannon is its own weapon.
+        self.weapon = self.__class__
+        self._init_reloader()
+
+    def step(self):
+        self._step_reloader()
+
+    def save_state(self, data):
+        super(Cannon, self).save_state(data)
+        self._save_reloader(data)
+
+    def load_state(self, data, i):
+        i = super(Cannon, self).load_state(data, i)
+        return self._load_reloader(data, i)
+
+    def fire(self):
+        direction = self.body.GetWorldVector(b2Vec2(0., 1.))
+        self.launch(self.ship, self.body.position, direction,
+                    self.body.angle, self.z)
+        self.body.ApplyImpulse(-self.recoil * direction, self.body.position)
+
+    @classmethod
+    def check_support(cls):
+        """Raise ImportError if a module that the cannon needs is
+        missing."""
+        pass
+
+    @classmethod
+    def launch(cls, ship, position, direction, angle, z):
+        """Launch shots from a muzzle at a position, facing a direction at
+        an angle, in radians."""
+        pass
+
+class PlasmaCannon(Cannon):
+    muzzle_velocity = 30.
+
+    @classmethod
+    def launch(cls, ship, position, direction, angle, z):
+        # Don't add the ship's linear velocity to the shot's linear velocity.
+        # If the ship is moving sideways, the shots would also move sideways.
+        # It doesn't look good, and it doesn't feel good either. Space Invaders
+        # was right.
+        #
+        # TODO: However, we may want to add the linear velocity component in
+        # the cannon's direction, or adjust the linear velocity for scrolling.
+        level = ship.level
+        level.shots_fired += 1
+        level.create(PlasmaShot, position=position,
+                     linear_velocity=(cls.muzzle_velocity * direction),
+                     angle=angle, z=z, group_index=ship.group_index)
+
+class MissileRamp(Cannon):
+    """Fires salvos of missiles in a fan, that seek the target of the
+    ship."""
+
+    tint = 1., 0.6, 0.5
+    recoil = 0.5
+    cooldown_mean = 1.2
+    cooldown_dev = 0.1
+    salvo_size = 3
+    spread = 0.6
+    launch_speed = 8.
+
+    @classmethod
+    def check_support(cls):
+        if numpy is None:
+            raise ImportError('Missiles need NumPy')
+
+    @classmethod
+    def launch(cls, ship, position, direction, angle, z):
+        level = ship.level
+        for i in xrange(cls.salvo_size):
+            missile_angle = angle + cls.spread * (float(i) /
+                                                  (cls.salvo_size - 1) - 0.5)
+            linear_velocity = (-cls.launch_speed * sin(missile_angle),
+                               cls.launch_speed * cos(missile_angle))
+            level.shots_fired += 1
+            level.create(Missile, ship=ship, position=position,
+                         linear_velocity=linear_velocity, angle=missile_angle,
+                         z=z, group_index=ship.group_index)
+
+class LaserCannon(Cannon):
+    """Fires beams that hit instantly, resolved by the laser beams of the
+    level."""
+
+    tint = 0.6, 1., 0.6
+    recoil = 0.3
+    cooldown_mean = 0.15
+    cooldown_dev = 0.03
+    beam_range = 40.
+    damage = 0.5
+    beam_color = 0.4, 1., 0.4
+
+    @classmethod
+    def check_support(cls):
+        if numpy is None:
+            raise ImportError('Lasers need NumPy')
+
+    @classmethod
+    def launch(cls, ship, position, direction, angle, z):
+        level = ship.level
+        level.shots_fired += 1
+        level.beams.fire(ship, position.tuple(), direction.tuple(),
+                         cls.beam_range, cls.damage, cls.beam_color)
+
+class Shot(Thing):
+    # Shots pass through each other.
+    category = SHOT_CATEGORY
+    mask_bits = 0xFFFF & ~SHOT_CATEGORY
+
+    # Power taken from what the shot hits.
+    damage = 1.
+
+    def get_position(self):
+        """Return where the shot is, or where it was deleted, since a shot
+        may be deleted by a contact before the other thing is told."""
+        if self.body is not None:
+            self.last_position = self.body.position.tuple()
+        return self.last_position
+
+    def delete(self):
+        if not self.deleted:
+            self.get_position()
+        super(Shot, self).delete()
+
+class PlasmaShot(Shot):
+    texture = 'plasma-shot.png'
+    scale = 0.015
+    group_index = -1
+    radius = 0.1
+    sensor = True
+    fade_dt = 0.1
+    pool_size = 64
+    collide_mask = 0xFFFF
+    splash_color = 0.5, 0.8, 1.
+
+    def collide(self, other):
+        particles = self.level.particles
+        if particles is not None:
+            # Splash back the way the shot came.
+            velocity = self.body.linearVelocity
+            particles.emit(self.get_position(), 12, 8., 0.3,
+                           self.splash_color,
+                           angle=atan2(-velocity.y, -velocity.x), spread=pi)
+        self.delete()
+
+class Missile(Shot):
+    """A missile that seeks the target of the ship that fired it.
+
+    Missiles are steered together by the missile swarm of the level. Ships
+    of other players can lock on to a missile to jam it.
+    """
+
+    texture = 'plasma-shot.png'
+    scale = 0.01
+    radius = 0.15
+    sensor = True
+    fade_dt = 0.1
+    pool_size = 128
+    collide_mask = 0xFFFF
+    targetable = True
+    damage = 4.
+    lifetime = 6.
+    color = 1., 0.5, 0.2
+
+    def __init__(self, level, ship=None, **kwargs):
+        red, green, blue = self.color
+        super(Missile, self).__init__(level=level, red=red, green=green,
+                                      blue=blue, **kwargs)
+        self._launch(ship)
+
+    def reuse(self, ship=None, **kwargs):
+        red, green, blue = self.color
+        super(Missile, self).reuse(red=red, green=green, blue=blue, **kwargs)
+        self._launch(ship)
+
+    def _launch(self, ship, lifetime=None):
+        self.ship = ship
+        self.jammed = False
+        self.swarm_handle = self.level.missiles.add(self)
+        self.expiry_timer = self.level.call_later(lifetime or self.lifetime,
+                                                  self.delete)
+
+    def delete(self):
+        if not self.deleted:
+            self.level.missiles.remove(self.swarm_handle)
+            self.swarm_handle = None
+            self.level.cancel_call(self.expiry_timer)
+            self.expiry_timer = None
+        super(Missile, self).delete()
+
+    def collide(self, other):
+        particles = self.level.particles
+        if particles is not None:
+            particles.emit(self.get_position(), 40, 10., 0.6, self.color)
+        self.delete()
+
+    def save(self, data):
+        ships = self.level.player_ships
+        data.append(ships.index(self.ship) if self.ship in ships else -1)
+        super(Missile, self).save(data)
+
+    @classmethod
+    def load(cls, level, data, i, thing=None):
+        ship_index = int(data[i])
+        ship = level.player_ships[ship_index] if ship_index >= 0 else None
+        if thing is not None:
+            thing.ship = ship
+        return super(Missile, cls).load(level, data, i + 1, thing, ship=ship)
+
+    def save_state(self, data):
+        super(Missile, self).save_state(data)
+        data.append(self.level.timers.get_remaining(self.expiry_timer))
+
+    def load_state(self, data, i):
+        i = super(Missile, self).load_state(data, i)
+        self.level.cancel_call(self.expiry_timer)
+        self.expiry_timer = self.level.timers.schedule(int(data[i]),
+                                                       self.delete)
+        return i + 1
+
+class MissileSwarm(object):
+    """Steers all the missiles of a level together, with NumPy.
+
+    The state of every missile is gathered into arrays, and the steering of
+    all of them is computed in one pass. A missile turns toward where the
+    target of its ship will be when it gets there, as fast as its turn rate
+    allows, while thrusting forward, and sideways motion is damped. A
+    missile without a target flies straight on. A jammed missile, one that
+    a ship of another player has locked on to, spins out of control. The
+    forces and angular velocities are then set body by body.
+    """
+
+    thrust_acceleration = 40.
+    drag = 1.
+    side_damping = 6.
+    turn_rate = 6.
+    jam_spin = 12.
+
+    # Longest time to lead the target by, in seconds.
+    max_lead = 1.
+
+    def __init__(self, level):
+        self.level = level
+        self.missiles = Registry()
+        self.jammed = []
+
+    def add(self, missile):
+        return self.missiles.add(missile)
+
+    def remove(self, handle):
+        self.missiles.remove(handle)
+
+    def __len__(self):
+        return len(self.missiles)
+
+    def step(self):
+        missiles = list(self.missiles)
+        for missile in self.jammed:
+            missile.jammed = False
+        self.jammed = []
+        if not missiles:
+            return
+        count = len(missiles)
+        bodies = [m.body for m in missiles]
+
+        # Gather the state of the missiles, and of the targets of the ships
+        # that fired them. The last row of targets is for missiles without
+        # a ship.
+        state = numpy.array([b.GetPosition().tuple() +
+                             b.GetLinearVelocity().tuple() + (b.GetAngle(),)
+                             for b in bodies])
+        ships = self.level.player_ships
+        ship_targets = numpy.zeros((len(ships) + 1, 4))
+        ship_has_target = numpy.zeros(len(ships) + 1, dtype=bool)
+        ship_indices = {}
+        for i, ship in enumerate(ships):
+            ship_indices[ship] = i
+            target = ship.target
+            if ship.deleted or target is None or target.deleted:
+                continue
+            position = target.body.position
+            linear_velocity = target.body.linearVelocity
+            ship_targets[i] = (position.x, position.y, linear_velocity.x,
+                               linear_velocity.y)
+            ship_has_target[i] = True
+        indices = numpy.array([ship_indices.get(m.ship, -1)
+                               for m in missiles])
+        targets = ship_targets[indices]
+        has_target = ship_has_target[indices]
+
+        # Ships only lock on to missiles of other players, so a locked
+        # missile is jammed.
+        jammed = numpy.zeros(count, dtype=bool)
+        for ship in ships:
+            missile = ship.target
+            if (not ship.deleted and isinstance(missile, Missile) and
+                    not missile.deleted):
+                missile.jammed = True
+                self.jammed.append(missile)
+                jammed[missiles.index(missile)] = True
+
+        # Steer.
+        positions = state[:, 0:2]
+        velocities = state[:, 2:4]
+        angles = state[:, 4]
+        headings = numpy.column_stack((-numpy.sin(angles),
+                                       numpy.cos(angles)))
+        offsets = targets[:, 0:2] - positions
+        distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+        speeds = numpy.maximum(numpy.hypot(velocities[:, 0],
+                                           velocities[:, 1]), 1.)
+        leads = numpy.minimum(distances / speeds, self.max_lead)
+        aims = offsets + targets[:, 2:4] * leads[:, numpy.newaxis]
+        errors = numpy.arctan2(-aims[:, 0], aims[:, 1]) - angles
+        errors = (errors + pi) % (2. * pi) - pi
+        angular_velocities = numpy.clip(errors / self.level.dt,
+                                        -self.turn_rate, self.turn_rate)
+        angular_velocities[~has_target] = 0.
+        angular_velocities[jammed] = self.jam_spin
+        forward_speeds = (velocities * headings).sum(axis=1)
+        side_velocities = (velocities -
+                           headings * forward_speeds[:, numpy.newaxis])
+        accelerations = (self.thrust_acceleration * headings -
+                         self.drag * velocities -
+                         self.side_damping * side_velocities)
+
+        # All missiles have the same mass.
+        forces = accelerations * bodies[0].GetMass()
+
+        # Apply.
+        for body, force, angular_velocity in \
+                zip(bodies, forces.tolist(), angular_velocities.tolist()):
+            body.ApplyForce(force, body.GetWorldCenter())
+            body.SetAngularVelocity(angular_velocity)
+
+class MountedCannon(Reloader):
+    """A cannon that is a shape on the hull of a ship, instead of a thing
+    with a body of its own.
+
+    Recoil is simulated kinematically. The cannon slides back along its
+    axis when fired, and a motor drives it forward again, within the same
+    limits and with the same force and speed as the prismatic joint of a
+    separate cannon. The hull takes the reaction of the motor and the
+    limits. Only the sprite slides; the shape stays in its slot.
+
+    The cannon stands in for a body in the transform buffer, so that its
+    sprite follows the hull.
+    """
+
+    lower_translation = -1.
+    motor_force = 20.
+    motor_speed = 5.
+
+    def __init__(self, ship, x, y, weapon=PlasmaCannon):
+        # The weapon is a cannon class, for its parameters and launches.
+        self.weapon = weapon
+        self.ship = ship
+        self.level = ship.level
+        self.x = x
+        self.y = y
+        self.z = ship.z - 0.1
+        self._init_reloader()
+
+        # Translation along the axis, and its speed.
+        self.translation = 0.
+        self.speed = 0.
+        radius = self.weapon.radius
+        self.mass = pi * radius ** 2 * self.weapon.density
+        create_circle_shape(ship.body, (x, y), radius=radius,
+                            density=self.weapon.density,
+                            group_index=ship.group_index,
+                            category_bits=ship.category,
+                            mask_bits=ship.mask_bits).userData = ship
+        self.sprite = None
+        if not self.level.headless:
+            texture = self.level.get_texture(self.weapon.texture)
+            red, green, blue = self.weapon.tint
+            self.sprite = MySprite(texture=texture, scale=self.weapon.scale,
+                                   red=red, green=green, blue=blue, alpha=0.,
+                                   z=self.z)
+            self.transform_handle = self.level.transforms.add(self)
+            self.level.transforms.connect(self.transform_handle, self.sprite)
+            self.sprite.alpha = rabbyt.lerp(end=1., dt=ship.fade_dt)
+            self.sprite_handle = self.level.sprites.add(self.sprite)
+
+    @property
+    def position(self):
+        return self.ship.body.GetWorldPoint((self.x,
+                                             self.y + self.translation))
+
+    @property
+    def angle(self):
+        return self.ship.body.angle
+
+    @property
+    def linearVelocity(self):
+        return self.ship.body.linearVelocity
+
+    @property
+    def angularVelocity(self):
+        return self.ship.body.angularVelocity
+
+    def IsSleeping(self):
+        return self.ship.body.IsSleeping()
+
+    def step(self):
+        self._step_reloader()
+        if self.translation or self.speed:
+            self._slide()
 
-class AsteroidField(Challenge):
-    """The player must navigate through an asteroid field."""
+    def _slide(self):
+        dt = self.level.dt
+        old_speed = self.speed
+        acceleration = self.motor_force / self.mass
+        self.speed = min(self.speed + acceleration * dt, self.motor_speed)
+        self.translation += self.speed * dt
+        if self.translation >= 0.:
+            self.translation = self.speed = 0.
+        elif self.translation <= self.lower_translation:
+            self.translation = self.lower_translation
+            self.speed = 0.
+        body = self.ship.body
+        impulse = body.GetWorldVector((0., (old_speed - self.speed) *
+                                       self.mass))
+        body.ApplyImpulse(impulse, self.position)
 
-    def __init__(self, **kwargs):
-        super(AsteroidField, self).__init__(**kwargs)
-        self.asteroids = []
+    def fire(self):
+        # Like Cannon.fire, but the recoil goes into the slide.
+        body = self.ship.body
+        direction = body.GetWorldVector(b2Vec2(0., 1.))
+        self.weapon.launch(self.ship, self.position, direction, body.angle,
+                           self.z)
+        self.speed -= self.weapon.recoil / self.mass
 
     def delete(self):
-        for asteroid in self.asteroids:
-            asteroid.delete()
-        self.asteroids = []
+        """Fade the sprite away, before the hull is destroyed."""
+        if self.sprite is not None:
+            self.sprite.alpha = rabbyt.lerp(end=0., dt=self.ship.fade_dt)
+            self.level.transforms.remove(self.transform_handle)
+            disconnect_sprite_from_body(self.sprite, self)
+            self.level.call_later(self.ship.fade_dt, self.level.sprites.remove,
+                                  self.sprite_handle)
+            self.sprite = None
 
-    def step(self):
-        self.asteroids = [a for a in self.asteroids if not a.deleted]
-        targets = [s for s in self.level.player_ships if not s.deleted]
-        if targets:
-            while len(self.asteroids) < 10:
-                target = random.choice(targets)
-                asteroid = self.create_asteroid(target)
-                self.asteroids.append(asteroid)
+    def save_state(self, data):
+        data.extend((self.translation, self.speed))
+        self._save_reloader(data)
 
-    def create_asteroid(self, target):
-        position_angle = 2 * pi * random.random()
-        distance = random.gauss(50., 1.)
-        position = (self.level.camera.position +
-                    distance * b2Vec2(cos(position_angle),
-                                      sin(position_angle)))
-        linear_velocity = target.body.position - position
-        linear_velocity.Normalize()
-        linear_velocity *= random.gauss(5., 1.)
-        orientation_angle = 2 * pi * random.random()
-        angular_velocity = random.gauss(0., 0.5)
-        asteroid = Asteroid(level=self.level, position=position,
-                            linear_velocity=linear_velocity,
-                            angle=orientation_angle,
-                            angular_velocity=angular_velocity)
-        return asteroid
+    def load_state(self, data, i):
+        self.translation, self.speed = data[i], data[i + 1]
+        return self._load_reloader(data, i + 2)
 
-class Cannon(Thing):
-    radius = 0.1
+class LaserBeam(object):
+    """A beam that has hit a thing, as told to the thing.
 
-    def __init__(self, ship, **kwargs):
-        super(Cannon, self).__init__(group_index=ship.group_index, **kwargs)
+    Beams have no bodies, but take part in contacts like shots do.
+    """
+
+    category = SHOT_CATEGORY
+    collide_mask = 0xFFFF
+    deleted = False
+
+    def __init__(self, ship, position, damage):
         self.ship = ship
-        self.firing = False
-        self.fire_time = self.level.time
+        self.group_index = ship.group_index
+        self.position = position
+        self.damage = damage
 
-class PlasmaCannon(Cannon):
-    texture = 'plasma-cannon-ao.png'
-    scale = 0.015
-    recoil = 1.5
-    cooldown_mean = 0.3
-    cooldown_dev = 0.05
-    muzzle_velocity = 30.
+    def get_position(self):
+        return self.position
 
-    def __init__(self, **kwargs):
-        super(PlasmaCannon, self).__init__(**kwargs)
-        self.cooldown = random.gauss(self.cooldown_mean, self.cooldown_dev)
+    def collide(self, other):
+        pass
 
-    def step(self):
-        if self.firing and self.fire_time + self.cooldown < self.level.time:
-            # Spread the cooldown, so that the cannons are only synchronized
-            # for the very first shots after a cease fire.
-            self.fire_time = self.level.time
-            self.cooldown = random.gauss(self.cooldown_mean, self.cooldown_dev)
-            self.fire()
+class LaserBeams(object):
+    """Resolves and draws the laser beams of a level.
 
-    def fire(self):
-        # Don't add the ship's linear velocity to the shot's linear velocity.
-        # If the ship is moving sideways, the shots would also move sideways.
-        # It doesn't look good, and it doesn't feel good either. Space Invaders
-        # was right.
-        #
-        # TODO: However, we may want to add the linear velocity component in
-        # the cannon's direction, or adjust the linear velocity for scrolling.
-        muzzle_velocity = b2Vec2(0., self.muzzle_velocity)
-        linear_velocity = self.body.GetWorldVector(muzzle_velocity)
-        shot = PlasmaShot(level=self.level, position=self.body.position,
-                          linear_velocity=linear_velocity,
-                          angle=self.body.angle, z=self.sprite.z,
-                          group_index=self.group_index)
-        recoil = self.recoil * self.body.GetWorldVector(b2Vec2(0., -1.))
-        self.body.ApplyImpulse(recoil, self.body.position)
+    Beams fired during a step are queued, and resolved together after the
+    things have been stepped, in one batched segment query against the
+    target grid. A beam stops at the first targetable thing in its path,
+    and the beam and the thing are told about the contact as if they had
+    collided. The beams of the last moments are drawn as lines, in a single
+    call.
+    """
 
-class MissileRamp(Cannon):
-    pass
+    # Time that a beam stays visible, in seconds.
+    beam_dt = 0.1
 
-class Shot(Thing):
-    pass
+    def __init__(self, level):
+        self.level = level
+        self.queue = []
 
-class PlasmaShot(Shot):
-    texture = 'plasma-shot.png'
-    scale = 0.015
-    group_index = -1
-    radius = 0.1
-    sensor = True
-    fade_dt = 0.1
+        # The beams to draw, as end points, color and time.
+        self.segments = deque()
 
-    def collide(self, other):
-        self.delete()
+    def fire(self, ship, position, direction, length, damage, color):
+        self.queue.append((ship, position, direction, length, damage,
+                           color))
 
-class Missile(Shot):
-    pass
+    def resolve(self):
+        queue = self.queue
+        if not queue:
+            return
+        self.queue = []
+        level = self.level
+        origins = numpy.array([beam[1] for beam in queue])
+        directions = numpy.array([beam[2] for beam in queue])
+        lengths = numpy.array([beam[3] for beam in queue])
+        group_indices = numpy.array([beam[0].group_index for beam in queue])
+        things, distances = level.get_target_grid().query_segments(
+            origins, directions, lengths, group_indices)
+        ends = origins + directions * numpy.minimum(distances,
+                                                    lengths)[:, numpy.newaxis]
+        ends = ends.tolist()
+        handlers = level.contact_handlers
+        particles = level.particles
+        for (ship, position, direction, length, damage, color), thing, end in \
+                zip(queue, things, ends):
+            if not level.headless:
+                self.segments.append((position, end, color, level.time))
+            if thing is None or thing.deleted:
+                continue
+            beam = LaserBeam(ship, tuple(end), damage)
+            key = LaserBeam, thing.__class__
+            handler = handlers.get(key)
+            if handler is None:
+                handler = handlers[key] = get_contact_handler(*key)
+            handler(beam, thing)
+            if particles is not None:
+                particles.emit(end, 3, 6., 0.2, color)
+
+    def draw(self):
+        segments = self.segments
+        time = self.level.time
+        while segments and segments[0][3] + self.beam_dt <= time:
+            segments.popleft()
+        if not segments:
+            return
+        coords = []
+        colors = []
+        for (x1, y1), (x2, y2), (red, green, blue), fire_time in segments:
+            alpha = 1. - (time - fire_time) / self.beam_dt
+            coords.extend((x1, y1, x2, y2))
+            colors.extend((red, green, blue, alpha, red, green, blue, alpha))
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT)
+        glDisable(GL_TEXTURE_2D)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE)
+        pyglet.graphics.draw(len(coords) // 2, GL_LINES, ('v2f', coords),
+                             ('c4f', colors))
+        glPopAttrib()
+
+# Cannon batteries that ships can carry, by name.
+BATTERIES = dict(plasma=PlasmaCannon, missile=MissileRamp, laser=LaserCannon)
+
+# Battery names, in the order of their indices in recordings.
+BATTERY_NAMES = ['plasma', 'missile', 'laser']
 
 class Ship(Thing):
     thrust_force = 700.
@@ -420,57 +2875,79 @@ class Ship(Thing):
     cannon_slots = [(-0.75, 1.), (0., 1.75), (0.75, 1.)]
     scale = 0.015
     fade_dt = 0.5
+    category = SHIP_CATEGORY
+    targetable = True
+    lock_range = 50.
+    exhaust_color = 1., 0.6, 0.2
 
-    def __init__(self, texture='ship-1-ao.png', **kwargs):
+    def __init__(self, texture='ship-1-ao.png', compound=False,
+                 battery='plasma', **kwargs):
+        # Check the battery before anything is created, since the cannons
+        # of a compound ship are not things of their own.
+        cannon_class = BATTERIES[battery]
+        cannon_class.check_support()
         self.texture = texture
         super(Ship, self).__init__(**kwargs)
         self.locking = False
         self.target = None
+
+        # The last ray used to find a target, for debug graphics. Targets
+        # are updated by the level.
+        self.lock_segment = None
         self.thrust = b2Vec2(0., 0.)
-        self.cannons = [None, None, None]
-        for i in xrange(3):
-            position = self.body.GetWorldPoint(self.cannon_slots[i])
-            z = self.sprite.attrgetter('z') - 0.1
-            self.cannons[i] = PlasmaCannon(level=self.level, ship=self,
-                                           position=position,
-                                           angle=self.body.angle, z=z)
-            create_prismatic_joint(self.level.world, self.body,
-                                   self.cannons[i].body, upper_translation=0.,
-                                   max_motor_force=20., motor_speed=5.)
-            self.angle = self.body.angle
+
+        # The cannons of a compound ship are shapes on its hull, and are
+        # stepped by the ship. Otherwise, they are things of their own,
+        # jointed to the hull.
+        self.compound = compound
+        self.battery = battery
+        if compound:
+            self.cannons = [MountedCannon(self, x, y, weapon=cannon_class)
+                            for x, y in self.cannon_slots]
+        else:
+            self.cannons = [None, None, None]
+            for i in xrange(3):
+                position = self.body.GetWorldPoint(self.cannon_slots[i])
+                z = self.z - 0.1
+                self.cannons[i] = cannon_class(level=self.level, ship=self,
+                                               position=position,
+                                               angle=self.body.angle, z=z)
+                create_prismatic_joint(self.level.world, self.body,
+                                       self.cannons[i].body,
+                                       upper_translation=0.,
+                                       max_motor_force=20., motor_speed=5.)
+        self.angle = self.body.angle
         self.linear_velocity = b2Vec2(0., 0.)
 
     # TODO: Set self.linear_velocity from e.g. scrolling.
     def step(self):
-        self._update_target()
         self._update_angle()
         self._apply_force()
         self._apply_torque()
+        if self.compound:
+            for cannon in self.cannons:
+                cannon.step()
 
-    def _update_target(self):
-        if self.locking:
-            if self.target is not None:
-                if self.target.body is None:
-                    self.target = None
-                else:
-                    distance = ((self.body.position -
-                                 self.target.body.position).Length() -
-                                self.target.radius)
-                    if distance >= 50.:
-                        self.target = None
-            if self.target is None:
-                segment = b2Segment()
-                segment.p1 = (self.body.position +
-                              self.body.GetWorldVector(b2Vec2(0., 5.)))
-                segment.p2 = (segment.p1 +
-                              self.body.GetWorldVector(b2Vec2(0., 20.)))
-                fraction, normal, shape = self.level.world.RaycastOne(segment,
-                                                                      True,
-                                                                      None)
-                if shape is not None:
-                    self.target = shape.GetBody().userData
-        else:
-            self.target = None
+    def delete(self):
+        if self.compound and not self.deleted:
+            for cannon in self.cannons:
+                cannon.delete()
+        super(Ship, self).delete()
+
+    def save_state(self, data):
+        super(Ship, self).save_state(data)
+        data.extend((self.thrust.x, self.thrust.y, self.locking))
+        for cannon in self.cannons:
+            cannon.save_state(data)
+
+    def load_state(self, data, i):
+        i = super(Ship, self).load_state(data, i)
+        self.thrust = b2Vec2(data[i], data[i + 1])
+        self.locking = bool(data[i + 2])
+        i += 3
+        for cannon in self.cannons:
+            i = cannon.load_state(data, i)
+        return i
 
     def _update_angle(self):
         if self.target is None:
@@ -484,6 +2961,16 @@ class Ship(Thing):
         force = (self.thrust * self.thrust_force +
                  linear_velocity_error * self.damping_force)
         self.body.ApplyForce(force, self.body.position)
+        particles = self.level.particles
+        if particles is not None and self.thrust.LengthSquared() > 0.:
+            # Exhaust, against the thrust.
+            thrust = self.thrust
+            linear_velocity = self.body.linearVelocity
+            origin = self.body.position - self.radius * thrust
+            particles.emit(origin.tuple(), 4, 12., 0.4,
+                           self.exhaust_color,
+                           linear_velocity=linear_velocity.tuple(),
+                           angle=atan2(-thrust.y, -thrust.x), spread=0.5)
 
     def _apply_torque(self):
         angle_error = self.angle - self.body.angle
@@ -495,6 +2982,54 @@ class Ship(Thing):
                   self.damping_torque * self.body.angularVelocity)
         self.body.ApplyTorque(torque)
 
+class RoundShip(Ship):
+    """A ship whose round is over when an asteroid hits it."""
+
+    collide_mask = ASTEROID_CATEGORY
+
+    def __init__(self, **kwargs):
+        super(RoundShip, self).__init__(**kwargs)
+        self.hit_time = None
+
+    def collide(self, other):
+        if self.hit_time is None:
+            self.hit_time = self.level.time
+
+class ScriptedShip(RoundShip):
+    """A ship that flies itself, for batch runs.
+
+    It keeps locking and firing, and thrusts away from the nearest asteroid
+    that comes too close, or back to where it started.
+    """
+
+    evade_distance = 10.
+
+    def __init__(self, **kwargs):
+        super(ScriptedShip, self).__init__(**kwargs)
+        self.home = self.body.position.tuple()
+        self.locking = True
+        for cannon in self.cannons:
+            cannon.firing = True
+
+    def step(self):
+        self._update_thrust()
+        super(ScriptedShip, self).step()
+
+    def _update_thrust(self):
+        # The target grid is up to date, since the ship is locking.
+        position = self.body.position
+        threat = self.level.target_grid.query_nearest(
+            position.x, position.y, self.evade_distance,
+            group_index=self.group_index)
+        if threat is None:
+            thrust = b2Vec2(*self.home) - position
+            if thrust.Length() < 1.:
+                thrust = b2Vec2(0., 0.)
+        else:
+            thrust = position - threat.body.position
+        thrust.Normalize()
+        self.thrust = thrust
+
 class ShipControls(object):
     def __init__(self, level, ship):
         self.level = level
@@ -529,6 +3064,446 @@ class ShipControls(object):
         for cannon in self.ship.cannons:
             cannon.firing = pyglet.window.key.SPACE in self.keys
 
+# Input bits of a ship, as recorded for replays.
+INPUT_LEFT = 0x01
+INPUT_RIGHT = 0x02
+INPUT_UP = 0x04
+INPUT_DOWN = 0x08
+INPUT_FIRE = 0x10
+INPUT_LOCK = 0x20
+
+def get_ship_input(ship):
+    """Return the input bits of a ship, as set by its controls."""
+    bits = 0
+    if ship.thrust.x < 0.:
+        bits |= INPUT_LEFT
+    if ship.thrust.x > 0.:
+        bits |= INPUT_RIGHT
+    if ship.thrust.y > 0.:
+        bits |= INPUT_UP
+    if ship.thrust.y < 0.:
+        bits |= INPUT_DOWN
+    if any(cannon.firing for cannon in ship.cannons):
+        bits |= INPUT_FIRE
+    if ship.locking:
+        bits |= INPUT_LOCK
+    return bits
+
+def set_ship_input(ship, bits):
+    left = float(bool(bits & INPUT_LEFT))
+    right = float(bool(bits & INPUT_RIGHT))
+    up = float(bool(bits & INPUT_UP))
+    down = float(bool(bits & INPUT_DOWN))
+    thrust = b2Vec2(right - left, up - down)
+    thrust.Normalize()
+    ship.thrust = thrust
+    for cannon in ship.cannons:
+        cannon.firing = bool(bits & INPUT_FIRE)
+    ship.locking = bool(bits & INPUT_LOCK)
+
+class InputRecorder(object):
+    """Records the input of the player ships of a level, step by step.
+
+    The recording starts with a header that holds the level seed, the
+    number of ships, the number of asteroids, whether the ships are compound
+    and their battery. Then follows an entry for
+    every change in the input of a ship, and an end entry with the number of
+    steps, followed by a digest of the final level state. Everything needed
+    to replay the level headlessly is in the file.
+
+    The input is read from the ships when each step starts, and then set
+    again from the recorded bits, so that the step sees exactly the
+    recorded input, even if controls change it from another thread.
+    """
+
+    magic = 'BRPL'
+    version = 5
+    header_format = '<4sBIBHBB'
+    entry_format = '<IBB'
+    digest_size = 20
+
+    # The ship index of the end entry.
+    end = 0xFF
+
+    def __init__(self, level, filename):
+        self.level = level
+        self.file = open(filename, 'wb')
+        self.file.write(struct.pack(self.header_format, self.magic,
+                                    self.version, level.seed,
+                                    len(level.player_ships),
+                                    level.challenge.asteroid_count,
+                                    level.compound_ships,
+                                    BATTERY_NAMES.index(level.battery)))
+        self.step_count = 0
+        self.inputs = [None] * len(level.player_ships)
+        level.recorder = self
+
+    def record(self):
+        for i, ship in enumerate(self.level.player_ships):
+            bits = get_ship_input(ship)
+            if bits != self.inputs[i]:
+                self.inputs[i] = bits
+                self.file.write(struct.pack(self.entry_format,
+                                            self.step_count, i, bits))
+            set_ship_input(ship, bits)
+        self.step_count += 1
+
+    def close(self):
+        self.level.recorder = None
+        self.file.write(struct.pack(self.entry_format, self.step_count,
+                                    self.end, 0))
+        self.file.write(self.level.get_digest())
+        self.file.close()
+
+def load_recording(filename):
+    """Load a recording.
+
+    Returns the seed, ship count, asteroid count, whether the ships are
+    compound, battery, input entries, step count and final digest.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    header_size = struct.calcsize(InputRecorder.header_format)
+    (magic, version, seed, ship_count, asteroid_count, compound_ships,
+     battery_index) = struct.unpack(InputRecorder.header_format,
+                                    data[:header_size])
+    if magic != InputRecorder.magic or version != InputRecorder.version:
+        raise ValueError('Not a recording: %s' % filename)
+    entry_size = struct.calcsize(InputRecorder.entry_format)
+    entries = []
+    offset = header_size
+    while True:
+        entry = struct.unpack(InputRecorder.entry_format,
+                              data[offset:offset + entry_size])
+        offset += entry_size
+        if entry[1] == InputRecorder.end:
+            break
+        entries.append(entry)
+    step_count = entry[0]
+    digest = data[offset:offset + InputRecorder.digest_size]
+    return (seed, ship_count, asteroid_count, bool(compound_ships),
+            BATTERY_NAMES[battery_index], entries, step_count, digest)
+
+class NetStats(object):
+    """Bandwidth and latency counters of a network endpoint.
+
+    Rates are measured over the last second, and the round-trip time is a
+    moving average.
+    """
+
+    def __init__(self, window=1.):
+        self.window = window
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.packets_dropped = 0
+        self.rtt = None
+        self._samples = deque()
+
+    def count_sent(self, size):
+        self.bytes_sent += size
+        self.packets_sent += 1
+        self._samples.append((default_timer(), size, 0))
+
+    def count_received(self, size):
+        self.bytes_received += size
+        self.packets_received += 1
+        self._samples.append((default_timer(), 0, size))
+
+    def add_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += 0.1 * (rtt - self.rtt)
+
+    def get_rates(self):
+        """Return the bytes sent and received per second."""
+        start_time = default_timer() - self.window
+        while self._samples and self._samples[0][0] < start_time:
+            self._samples.popleft()
+        sent = sum(sample[1] for sample in self._samples)
+        received = sum(sample[2] for sample in self._samples)
+        return sent / self.window, received / self.window
+
+    def format(self):
+        sent_rate, received_rate = self.get_rates()
+        rtt = '-' if self.rtt is None else '%.1f ms' % (1000. * self.rtt)
+        return ('sent %.1f kB/s  received %.1f kB/s  rtt %s  '
+                'dropped %d' % (sent_rate / 1000., received_rate / 1000.,
+                                rtt, self.packets_dropped))
+
+def receive_packets(sock, stats, size=65536):
+    """Read all packets waiting on a non-blocking socket."""
+    packets = []
+    while True:
+        try:
+            data, address = sock.recvfrom(size)
+        except socket.error:
+            # Nothing left, or an ICMP error from an earlier send.
+            return packets
+        stats.count_received(len(data))
+        packets.append((data, address))
+
+# Sent positions are in 1/256 m, and angles in 1/65536 turn.
+POSITION_SCALE = 256.
+ANGLE_SCALE = 65536. / (2. * pi)
+
+def quantize_transform(x, y, angle):
+    """Quantize a transform for sending. Positions are clamped to the range
+    of shorts, and angles wrap around.
+
+    >>> quantize_transform(1.5, -200., -pi)
+    (384, -32768, 32768)
+    >>> quantize_transform(0., 0., 2. * pi)
+    (0, 0, 0)
+    >>> dequantize_transform(*quantize_transform(1.5, 0.25, pi / 2.))
+    (1.5, 0.25, 1.5707963267948966)
+    """
+    qx = min(max(int(round(x * POSITION_SCALE)), -32768), 32767)
+    qy = min(max(int(round(y * POSITION_SCALE)), -32768), 32767)
+    return qx, qy, int(round(angle * ANGLE_SCALE)) & 0xFFFF
+
+def dequantize_transform(qx, qy, qangle):
+    return qx / POSITION_SCALE, qy / POSITION_SCALE, qangle / ANGLE_SCALE
+
+# Packet formats. The client sends its input, with the sequence number of
+# the last update that it has received, and a timestamp that the server
+# echoes back. The server sends updates: a header, the serial numbers of
+# removed things, and an entry for every thing that changed. A new thing's
+# entry includes its texture index, scale, z and color.
+INPUT_PACKET_FORMAT = '<4sIIdB'
+UPDATE_HEADER_FORMAT = '<4sIIddHH'
+UPDATE_ENTRY_FORMAT = '<IBhhH'
+UPDATE_SPAWN_FORMAT = '<Bff3B'
+
+TEXTURE_INDICES = dict((texture, i)
+                       for i, texture in enumerate(SPRITE_TEXTURES))
+
+class NetServer(object):
+    """Streams the things of a level to a client over UDP, and takes the
+    input of a ship from it.
+
+    Updates are quantized and delta-compressed against the last update that
+    the client has acknowledged, so only things that moved, appeared or
+    disappeared since then are sent. Things that don't fit in one update
+    are left for the next one.
+    """
+
+    # Time between updates, in seconds.
+    send_dt = 1. / 30.
+
+    history_size = 64
+    max_entries = 2048
+
+    def __init__(self, level, ship, port, host=''):
+        self.level = level
+        self.ship = ship
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.address = None
+        self.stats = NetStats()
+        self.seq = 0
+        self.ack = 0
+        self.input_seq = 0
+        self.client_time = 0.
+
+        # Sent updates, by sequence number, with their send times.
+        self.updates = {}
+
+    def close(self):
+        self.socket.close()
+
+    def receive(self):
+        """Apply the latest input from the client."""
+        for data, address in receive_packets(self.socket, self.stats):
+            try:
+                magic, seq, ack, client_time, bits = \
+                    struct.unpack(INPUT_PACKET_FORMAT, data)
+            except struct.error:
+                magic = None
+            if magic != 'BRIN' or seq <= self.input_seq:
+                self.stats.packets_dropped += 1
+                continue
+            self.address = address
+            self.input_seq = seq
+            self.client_time = client_time
+            if ack > self.ack and ack in self.updates:
+                self.ack = ack
+                send_time, state = self.updates[ack]
+                self.stats.add_rtt(default_timer() - send_time)
+            with self.level.lock:
+                if not self.ship.deleted:
+                    set_ship_input(self.ship, bits)
+
+    def send(self):
+        """Send an update to the client, if it has been heard from."""
+        if self.address is None:
+            return
+        if self.ack in self.updates:
+            base_seq = self.ack
+            base_state = self.updates[base_seq][1]
+        else:
+            base_seq = 0
+            base_state = {}
+        state = {}
+        entries = []
+        with self.level.lock:
+            level_time = self.level.time
+            for thing in self.level.things:
+                if thing.texture is None:
+                    continue
+                position = thing.body.position
+                transform = quantize_transform(position.x, position.y,
+                                               thing.body.angle)
+                serial = thing.serial
+                base_transform = base_state.get(serial)
+                if transform != base_transform:
+                    if len(entries) == self.max_entries:
+                        # The client keeps what it has.
+                        if base_transform is not None:
+                            state[serial] = base_transform
+                        continue
+                    entry = struct.pack(UPDATE_ENTRY_FORMAT, serial,
+                                        base_transform is None, *transform)
+                    if base_transform is None:
+                        red, green, blue = (min(max(int(255. * c), 0), 255)
+                                            for c in thing.color)
+                        entry += struct.pack(UPDATE_SPAWN_FORMAT,
+                                             TEXTURE_INDICES[thing.texture],
+                                             thing.scale, thing.z,
+                                             red, green, blue)
+                    entries.append(entry)
+                state[serial] = transform
+        removed = [s for s in base_state if s not in state]
+        self.seq += 1
+        packet = (struct.pack(UPDATE_HEADER_FORMAT, 'BRST', self.seq,
+                              base_seq, self.client_time, level_time,
+                              len(removed), len(entries)) +
+                  struct.pack('<%dI' % len(removed), *removed) +
+                  ''.join(entries))
+        self.socket.sendto(packet, self.address)
+        self.stats.count_sent(len(packet))
+        self.updates[self.seq] = default_timer(), state
+        self.updates.pop(self.seq - self.history_size, None)
+
+class NetClient(object):
+    """Receives the things of a level from a server, and sends it the input
+    of the local player.
+
+    The last two updates are kept, with the times they arrived, for
+    interpolating between them. The empty state is always kept, so that
+    updates the server sends from scratch are accepted, such as after an
+    outage that outlasts its history.
+
+    >>> level = Level(headless=True, seed=1)
+    >>> level.create_player_ships()
+    >>> server = NetServer(level, level.player_ships[0], 0, '127.0.0.1')
+    >>> client = NetClient(server.socket.getsockname())
+    >>> def tick(delivered=True):
+    ...     client.send(0)
+    ...     server.receive()
+    ...     level.step()
+    ...     server.send()
+    ...     if delivered:
+    ...         client.receive()
+    ...     else:
+    ...         packets = receive_packets(client.socket, client.stats)
+    >>> for i in xrange(10):
+    ...     tick()
+    >>> for i in xrange(2 * NetServer.history_size):
+    ...     tick(delivered=False)
+    >>> for i in xrange(10):
+    ...     tick()
+    >>> client.ack == server.seq
+    True
+    >>> client.close()
+    >>> server.close()
+    """
+
+    history_size = 64
+
+    def __init__(self, address):
+        self.address = address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.stats = NetStats()
+        self.seq = 0
+        self.ack = 0
+
+        # Received states, by sequence number. A state maps the serial number
+        # of every thing to its transform and spawn info.
+        self.states = {0: {}}
+        self.updates = deque(maxlen=2)
+
+    def close(self):
+        self.socket.close()
+
+    def send(self, bits):
+        self.seq += 1
+        packet = struct.pack(INPUT_PACKET_FORMAT, 'BRIN', self.seq, self.ack,
+                             default_timer(), bits)
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error:
+            return
+        self.stats.count_sent(len(packet))
+
+    def receive(self):
+        header_size = struct.calcsize(UPDATE_HEADER_FORMAT)
+        entry_size = struct.calcsize(UPDATE_ENTRY_FORMAT)
+        spawn_size = struct.calcsize(UPDATE_SPAWN_FORMAT)
+        for data, address in receive_packets(self.socket, self.stats):
+            try:
+                (magic, seq, base_seq, client_time, level_time, removed_count,
+                 entry_count) = struct.unpack(UPDATE_HEADER_FORMAT,
+                                              data[:header_size])
+            except struct.error:
+                magic = None
+            if (magic != 'BRST' or seq <= self.ack or
+                    base_seq not in self.states):
+                self.stats.packets_dropped += 1
+                continue
+            state = dict(self.states[base_seq])
+            offset = header_size + 4 * removed_count
+            for serial in struct.unpack('<%dI' % removed_count,
+                                        data[header_size:offset]):
+                state.pop(serial, None)
+            for i in xrange(entry_count):
+                serial, new, qx, qy, qangle = \
+                    struct.unpack(UPDATE_ENTRY_FORMAT,
+                                  data[offset:offset + entry_size])
+                offset += entry_size
+                if new:
+                    spawn = struct.unpack(UPDATE_SPAWN_FORMAT,
+                                          data[offset:offset + spawn_size])
+                    offset += spawn_size
+                else:
+                    spawn = state[serial][3]
+                state[serial] = qx, qy, qangle, spawn
+            self.states[seq] = state
+            for old_seq in [s for s in self.states
+                            if 0 < s < seq - self.history_size]:
+                del self.states[old_seq]
+            self.ack = seq
+            if client_time:
+                self.stats.add_rtt(default_timer() - client_time)
+            self.updates.append((level_time, default_timer(), state))
+
+class RemoteCannon(object):
+    def __init__(self):
+        self.firing = False
+
+class RemoteShip(object):
+    """Stands in for a ship on a server, so that ship controls can drive
+    it."""
+
+    def __init__(self, cannon_count=3):
+        self.thrust = b2Vec2(0., 0.)
+        self.locking = False
+        self.cannons = [RemoteCannon() for i in xrange(cannon_count)]
+
 class CameraControls(object):
     def __init__(self, level, camera):
         self.level = level
@@ -546,60 +3521,160 @@ class CameraControls(object):
 class Asteroid(Thing):
     texture = 'asteroid-ao.png'
     density = 10.
+    pool_size = 32
+    park_spacing = 12.
+    category = ASTEROID_CATEGORY
+    collide_mask = SHOT_CATEGORY
+    targetable = True
 
-    def __init__(self, group_index=ASTEROID_GROUP, **kwargs):
-        self.radius = random.gauss(4.5, 0.2)
+    def __init__(self, level, group_index=ASTEROID_GROUP, radius=None,
+                 color=None, **kwargs):
+        if radius is None:
+            radius = level.random.gauss(4.5, 0.2)
+        self.radius = radius
         self.scale = 0.0075 * self.radius
         self.power = self.radius ** 2
-        red = random.gauss(0.95, 0.05)
-        green = random.gauss(0.95, 0.05)
-        blue = random.gauss(0.95, 0.05)
-        super(Asteroid, self).__init__(group_index=group_index,
+        if color is None:
+            color = (level.random.gauss(0.95, 0.05),
+                     level.random.gauss(0.95, 0.05),
+                     level.random.gauss(0.95, 0.05))
+        red, green, blue = self.color = color
+        super(Asteroid, self).__init__(level=level, group_index=group_index,
                                        red=red, green=green, blue=blue,
                                        **kwargs)
 
+    def reuse(self, group_index=ASTEROID_GROUP, **kwargs):
+        # Pooled asteroids keep their size and color.
+        self.power = self.radius ** 2
+        red, green, blue = self.color
+        super(Asteroid, self).reuse(group_index=group_index,
+                                    red=red, green=green, blue=blue,
+                                    **kwargs)
+
     def collide(self, other):
-        if isinstance(other, Shot):
-            self.power -= 1.
+        if other.category & SHOT_CATEGORY:
+            self.power -= other.damage
+            particles = self.level.particles
+            if particles is not None:
+                particles.emit(other.get_position(), 6, 4., 0.5,
+                               self.color)
             if self.power <= 0.:
+                self.level.asteroids_destroyed += 1
                 self.delete()
 
+    def delete(self):
+        particles = self.level.particles
+        if not self.deleted and self.power <= 0. and particles is not None:
+            # Break up into dust, more for bigger asteroids.
+            linear_velocity = self.body.linearVelocity
+            particles.emit(self.body.position.tuple(),
+                           int(40. * self.radius), 2. * self.radius, 1.5,
+                           self.color, linear_velocity=linear_velocity.tuple())
+        super(Asteroid, self).delete()
+
+    def save(self, data):
+        data.append(self.radius)
+        data.extend(self.color)
+        super(Asteroid, self).save(data)
+
+    @classmethod
+    def load(cls, level, data, i, thing=None):
+        radius = data[i]
+        color = tuple(data[i + 1:i + 4])
+        return super(Asteroid, cls).load(level, data, i + 4, thing,
+                                         radius=radius, color=color)
+
+    def save_state(self, data):
+        super(Asteroid, self).save_state(data)
+        data.append(self.power)
+
+    def load_state(self, data, i):
+        i = super(Asteroid, self).load_state(data, i)
+        self.power = data[i]
+        return i + 1
+
+# The types of things, besides player ships and their cannons, that are saved
+# in level snapshots.
+SNAPSHOT_TYPES = [Asteroid, PlasmaShot, Missile]
+
 class GameScreen(object):
-    def __init__(self, window, debug=False, single=True):
+    # Most steps to take in one frame to catch up with the clock.
+    max_steps = 5
+
+    def __init__(self, window, debug=False, single=True, atlas=False,
+                 assets=None, threaded=False, record=None, serve=None,
+                 governed=True, compound=False, battery='plasma'):
         self.window = window
-        self.level = Level(debug)
-        if single:
-            position_1 = position=(0., -10.)
-        else:
-            position_1 = position=(-10., -10.)
-            position_2 = position=(10., -10.)
-        ship_1 = Ship(level=self.level, position=position_1, z=2.,
-                      group_index=PLAYER_1_GROUP)
-        self.level.player_ships.append(ship_1)
-        if not single:
-            ship_2 = Ship(texture='ship-2-ao.png', level=self.level,
-                          position=position_2, z=1.,
-                          group_index=PLAYER_2_GROUP)
-            self.level.player_ships.append(ship_2)
+
+        # A recording must step the same way when replayed, so it can't be
+        # governed.
+        self.level = Level(debug, atlas=atlas, assets=assets,
+                           interpolated=threaded,
+                           governed=(governed and record is None),
+                           compound_ships=compound, battery=battery)
+        self.level.create_player_ships(single=(single and serve is None))
+        self.recorder = None
+        if record is not None:
+            self.recorder = InputRecorder(self.level, record)
+
+        # When serving, the second ship is flown by a client.
+        self.server = None
+        self.net_stats = None
+        if serve is not None:
+            self.server = NetServer(self.level, self.level.player_ships[1],
+                                    serve)
+            self.net_stats = self.server.stats
+            pyglet.clock.schedule_interval(self.update_client,
+                                           self.server.send_dt)
         self.controls = []
         self.controls.append(ShipControls(self.level,
                                           self.level.player_ships[0]))
         self.controls.append(CameraControls(self.level,
                                             self.level.camera))
         self.time = 0.
-        pyglet.clock.schedule_interval(self.step, self.level.dt)
+        self.simulation = None
+        if threaded:
+            self.simulation = SimulationThread(self.level)
+            self.simulation.start()
+        else:
+            pyglet.clock.schedule_interval(self.step, self.level.dt)
 
     def step(self, dt):
         self.time += dt
+        max_steps = self.max_steps
+        governor = self.level.governor
+        if governor is not None:
+            max_steps = governor.max_steps
+        steps = 0
         while self.level.time + self.level.dt < self.time:
+            if steps == max_steps:
+                # Let the time go rather than fall further behind.
+                if governor is not None:
+                    governor.drop_steps(int((self.time - self.level.time) /
+                                            self.level.dt))
+                self.time = self.level.time
+                break
             self.level.step()
+            steps += 1
+
+    def update_client(self, dt):
+        self.server.receive()
+        self.server.send()
 
     def on_draw(self):
         self.window.clear()
         self.level.draw(self.window.width, self.window.height)
 
     def close(self):
-        pyglet.clock.unschedule(self.step)
+        if self.simulation is None:
+            pyglet.clock.unschedule(self.step)
+        else:
+            self.simulation.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.server is not None:
+            pyglet.clock.unschedule(self.update_client)
+            self.server.close()
 
     def on_key_press(self, symbol, modifiers):
         for controls in self.controls:
@@ -609,8 +3684,107 @@ class GameScreen(object):
         for controls in self.controls:
             controls.on_key_release(symbol, modifiers)
             
+class ClientScreen(object):
+    """Shows a level that runs on a server, and flies a ship on it.
+
+    Sprites are placed between the last two updates from the server, from
+    when the last one arrived until the next one is due.
+    """
+
+    def __init__(self, window, address, assets=None):
+        self.window = window
+        self.level = None
+        self.assets = assets or AssetManager()
+        self.client = NetClient(address)
+        self.net_stats = self.client.stats
+        self.camera = Camera()
+        self.sprites = SpriteLayers()
+        self.serial_sprites = {}
+        self.stars_texture = self.assets.get_image('stars.png')
+        self.stars_texture = \
+            pyglet.image.TileableTexture.create_for_image(self.stars_texture)
+        self.ship = RemoteShip()
+        self.controls = [ShipControls(None, self.ship),
+                         CameraControls(None, self.camera)]
+        pyglet.clock.schedule_interval(self.update_server, NetServer.send_dt)
+
+    def update_server(self, dt):
+        self.client.send(get_ship_input(self.ship))
+        self.client.receive()
+
+    def _update_sprites(self):
+        updates = self.client.updates
+        if not updates:
+            return
+        level_time, arrival_time, state = updates[-1]
+        previous_state = state
+        alpha = 1.
+        if len(updates) == 2:
+            previous_level_time, previous_arrival_time, previous_state = \
+                updates[0]
+            dt = max(level_time - previous_level_time, 1e-3)
+            alpha = min(max((default_timer() - arrival_time) / dt, 0.), 1.)
+        for serial in [s for s in self.serial_sprites if s not in state]:
+            self.sprites.remove(self.serial_sprites.pop(serial))
+        for serial, (qx, qy, qangle, spawn) in state.iteritems():
+            sprite = self.serial_sprites.get(serial)
+            if sprite is None:
+                texture_index, scale, z, red, green, blue = spawn
+                texture = self.assets.get_texture(
+                    SPRITE_TEXTURES[texture_index], mipmapped=True)
+                sprite = MySprite(texture=texture, scale=scale, z=z,
+                                  red=(red / 255.), green=(green / 255.),
+                                  blue=(blue / 255.))
+                self.sprites.add(sprite)
+                self.serial_sprites[serial] = sprite
+            x, y, angle = dequantize_transform(qx, qy, qangle)
+            previous_transform = previous_state.get(serial)
+            if previous_transform is not None:
+                previous_x, previous_y, previous_angle = \
+                    dequantize_transform(*previous_transform[:3])
+                angle_offset = (angle - previous_angle + pi) % (2. * pi) - pi
+                x = previous_x + alpha * (x - previous_x)
+                y = previous_y + alpha * (y - previous_y)
+                angle = previous_angle + alpha * angle_offset
+            sprite.x = x
+            sprite.y = y
+            sprite.rot = rad_to_deg(angle)
+
+    def on_draw(self):
+        self.window.clear()
+        width, height = self.window.width, self.window.height
+        glColor3f(1., 1., 1.)
+        self.stars_texture.blit_tiled(0, 0, 0, width, height)
+        glPushMatrix()
+        glTranslatef(float(width // 2), float(height // 2), 0.)
+        scale = float(min(width, height)) / self.camera.scale
+        glScalef(scale, scale, scale)
+        glTranslatef(-self.camera.position.x, -self.camera.position.y, 0.)
+        self._update_sprites()
+        self.sprites.render(view=self.camera.get_view(width, height))
+        glPopMatrix()
+
+    def close(self):
+        pyglet.clock.unschedule(self.update_server)
+        self.client.close()
+
+    def on_key_press(self, symbol, modifiers):
+        for controls in self.controls:
+            controls.on_key_press(symbol, modifiers)
+
+    def on_key_release(self, symbol, modifiers):
+        for controls in self.controls:
+            controls.on_key_release(symbol, modifiers)
+
 class MyWindow(pyglet.window.Window):
-    def __init__(self, fps=False, debug=False, single=True, **kwargs):
+    def __init__(self, fps=False, debug=False, single=True, atlas=False,
+                 threaded=False, record=None, serve=None, connect=None,
+                 governed=True, compound=False, battery='plasma',
+                 **kwargs):
+        # Decode images while the window is being created.
+        assets = AssetManager()
+        assets.preload()
+
         super(MyWindow, self).__init__(**kwargs)
 
         # Grab mouse and keyboard if we're in fullscreen mode.
@@ -627,7 +3801,18 @@ class MyWindow(pyglet.window.Window):
         self.fps_display = pyglet.clock.ClockDisplay() if fps else None
 
         # Most window calls are delegated to a screen.
-        self.my_screen = GameScreen(self, debug=debug, single=single)
+        if connect is None:
+            self.my_screen = GameScreen(self, debug=debug, single=single,
+                                        atlas=atlas, assets=assets,
+                                        threaded=threaded, record=record,
+                                        serve=serve, governed=governed,
+                                        compound=compound, battery=battery)
+        else:
+            self.my_screen = ClientScreen(self, connect, assets=assets)
+
+        # Create timing overlay, hidden until toggled.
+        self.timing_overlay = TimingOverlay(self.my_screen.level,
+                                            self.my_screen.net_stats)
 
     def on_draw(self):
         # Delegate to screen.
@@ -637,10 +3822,17 @@ class MyWindow(pyglet.window.Window):
         if self.fps_display is not None:
             self.fps_display.draw()
 
+        # Display timing overlay.
+        if self.timing_overlay.visible:
+            self.timing_overlay.draw(self.width, self.height)
+
     def on_key_press(self, symbol, modifiers):
         if symbol == pyglet.window.key.ESCAPE:
             # Close window.
             self.on_close()
+        elif symbol == pyglet.window.key.F3:
+            # Toggle timing overlay.
+            self.timing_overlay.visible = not self.timing_overlay.visible
         elif symbol == pyglet.window.key.F11:
             # Toggle fullscreen mode.
             self.set_fullscreen(not self.fullscreen)
@@ -658,6 +3850,379 @@ class MyWindow(pyglet.window.Window):
         # Delegate to screen.
         self.my_screen.on_key_release(symbol, modifiers)
 
+    def on_close(self):
+        self.my_screen.close()
+        super(MyWindow, self).on_close()
+
+def run_headless(steps, single=True, seed=None):
+    """Step a headless level as fast as possible.
+
+    Returns the level and the elapsed wall-clock time, in seconds.
+    """
+    level = Level(headless=True, seed=seed)
+    level.create_player_ships(single=single)
+    start_time = default_timer()
+    for i in xrange(steps):
+        level.step()
+    return level, default_timer() - start_time
+
+def run_replay(filename):
+    """Replay a recording headlessly, as fast as possible.
+
+    Returns the level, the elapsed wall-clock time, in seconds, and whether
+    the final level state matches the recorded one.
+    """
+    (seed, ship_count, asteroid_count, compound_ships, battery, entries,
+     step_count, digest) = load_recording(filename)
+    level = Level(headless=True, asteroid_count=asteroid_count, seed=seed,
+                  compound_ships=compound_ships, battery=battery)
+    level.create_player_ships(single=(ship_count == 1))
+    entries = deque(entries)
+    start_time = default_timer()
+    for i in xrange(step_count):
+        while entries and entries[0][0] == i:
+            step, ship_index, bits = entries.popleft()
+            set_ship_input(level.player_ships[ship_index], bits)
+        level.step()
+    elapsed = default_timer() - start_time
+    return level, elapsed, level.get_digest() == digest
+
+def run_server(port, steps, seed=None):
+    """Serve a headless two-player level in real time, to a client that
+    flies the second ship. Returns the server."""
+    level = Level(headless=True, seed=seed)
+    level.create_player_ships(single=False)
+    server = NetServer(level, level.player_ships[1], port)
+    send_steps = max(int(round(server.send_dt / level.dt)), 1)
+    next_time = default_timer()
+    try:
+        for i in xrange(steps):
+            if i % send_steps == 0:
+                server.receive()
+                server.send()
+            level.step()
+            next_time += level.dt
+            time.sleep(max(next_time - default_timer(), 0.))
+    finally:
+        server.close()
+    return server
+
+def run_client(address, duration, bits=INPUT_FIRE):
+    """Fly a ship on a server for a while, with fixed input, without
+    drawing. Returns the client."""
+    client = NetClient(address)
+    end_time = default_timer() + duration
+    next_time = default_timer()
+    try:
+        while default_timer() < end_time:
+            client.send(bits)
+            client.receive()
+            next_time += NetServer.send_dt
+            time.sleep(max(next_time - default_timer(), 0.))
+    finally:
+        client.close()
+    return client
+
+def run_round(options):
+    """Run a round of a scripted ship against an asteroid field, until the
+    ship is hit or the steps run out. Returns the results."""
+    seed, max_steps, asteroid_count, compound_ships = options
+    start_time = default_timer()
+    level = Level(headless=True, seed=seed, asteroid_count=asteroid_count,
+                  compound_ships=compound_ships)
+    level.create_player_ships(ship_class=ScriptedShip)
+    ship = level.player_ships[0]
+    steps = 0
+    while steps < max_steps and ship.hit_time is None and not ship.deleted:
+        level.step()
+        steps += 1
+    survived = ship.hit_time is None and not ship.deleted
+    return dict(seed=seed, steps=steps, survived=survived,
+                survival_time=(level.time if ship.hit_time is None
+                               else ship.hit_time),
+                shots_fired=level.shots_fired,
+                asteroids_destroyed=level.asteroids_destroyed,
+                elapsed=default_timer() - start_time)
+
+def run_batch(rounds, seed=0, max_steps=7200, asteroid_count=10,
+              processes=None, compound_ships=False):
+    """Run rounds in a pool of processes, one seed after another, and
+    yield their results as they finish."""
+    pool = multiprocessing.Pool(processes)
+    try:
+        options = [(seed + i, max_steps, asteroid_count, compound_ships)
+                   for i in xrange(rounds)]
+        for results in pool.imap_unordered(run_round, options):
+            yield results
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def summarize_rounds(rounds, elapsed):
+    """Aggregate the results of rounds."""
+    count = float(max(len(rounds), 1))
+    steps = sum(r['steps'] for r in rounds)
+    return dict(rounds=len(rounds), elapsed=elapsed,
+                rounds_per_sec=len(rounds) / max(elapsed, 1e-9),
+                steps_per_sec=steps / max(elapsed, 1e-9),
+                survival_rate=sum(r['survived'] for r in rounds) / count,
+                survival_time_mean=(sum(r['survival_time'] for r in rounds) /
+                                    count),
+                shots_fired_mean=(sum(r['shots_fired'] for r in rounds) /
+                                  count),
+                asteroids_destroyed_mean=(sum(r['asteroids_destroyed']
+                                              for r in rounds) / count))
+
+class VectorEnv(object):
+    """A Gym-style environment of several headless levels, stepped together.
+
+    Each level has a ship that is steered by actions, an array with a row
+    per level of thrust x, thrust y, firing and locking, where firing and
+    locking are on when positive. Observations are read once per step, and
+    only for the observed asteroids, into arrays that are allocated once
+    and returned by every call, so copy them to keep them:
+
+        ship       position x and y, angle, linear velocity x and y, and
+                   angular velocity of the ship, per level
+        asteroids  position x and y, linear velocity x and y, and radius of
+                   up to max_asteroids asteroids, per level
+        asteroid_mask
+                   which asteroid rows are in use
+
+    The reward is the number of asteroids destroyed in the step. An episode
+    is done when an asteroid hits the ship, or after max_steps steps, and
+    its level is then reset, as in Gym's vector environments.
+    """
+
+    hit_reward = -10.
+
+    def __init__(self, count, seed=0, asteroid_count=10, max_asteroids=32,
+                 max_steps=3600, frame_skip=1, compound_ships=False):
+        if numpy is None:
+            raise ImportError('The vectorized environment needs NumPy')
+        self.count = count
+        self.seed = seed
+        self.asteroid_count = asteroid_count
+        self.max_steps = max_steps
+        self.frame_skip = frame_skip
+        self.compound_ships = compound_ships
+        self.levels = [None] * count
+        self.episodes = 0
+        self.ship_observations = numpy.zeros((count, 6))
+        self.asteroid_observations = numpy.zeros((count, max_asteroids, 5))
+        self.asteroid_mask = numpy.zeros((count, max_asteroids), dtype=bool)
+        self.observations = dict(ship=self.ship_observations,
+                                 asteroids=self.asteroid_observations,
+                                 asteroid_mask=self.asteroid_mask)
+        self.rewards = numpy.zeros(count)
+        self.dones = numpy.zeros(count, dtype=bool)
+        self._steps = [0] * count
+
+    def reset(self):
+        for i in xrange(self.count):
+            self._reset_level(i)
+        return self.observations
+
+    def _reset_level(self, i):
+        level = Level(headless=True, seed=(self.seed + self.episodes),
+                      asteroid_count=self.asteroid_count,
+                      compound_ships=self.compound_ships)
+        level.create_player_ships(ship_class=RoundShip)
+        self.episodes += 1
+        self.levels[i] = level
+        self._steps[i] = 0
+        self._observe(i)
+
+    def step(self, actions):
+        """Step every level with its action, and return the observations,
+        rewards, done flags and infos."""
+        infos = []
+        for i, level in enumerate(self.levels):
+            ship = level.player_ships[0]
+            thrust_x, thrust_y, firing, locking = actions[i]
+            thrust = b2Vec2(float(thrust_x), float(thrust_y))
+            if thrust.Length() > 1.:
+                thrust.Normalize()
+            ship.thrust = thrust
+            for cannon in ship.cannons:
+                cannon.firing = firing > 0.
+            ship.locking = locking > 0.
+            asteroids_destroyed = level.asteroids_destroyed
+            for j in xrange(self.frame_skip):
+                level.step()
+            self._steps[i] += self.frame_skip
+            hit = ship.hit_time is not None or ship.deleted
+            reward = level.asteroids_destroyed - asteroids_destroyed
+            if hit:
+                reward += self.hit_reward
+            self.rewards[i] = reward
+            self.dones[i] = hit or self._steps[i] >= self.max_steps
+            infos.append(dict(time=level.time, hit=hit,
+                              shots_fired=level.shots_fired,
+                              asteroids_destroyed=level.asteroids_destroyed))
+            if self.dones[i]:
+                self._reset_level(i)
+            else:
+                self._observe(i)
+        return self.observations, self.rewards, self.dones, infos
+
+    def _observe(self, i):
+        level = self.levels[i]
+        body = level.player_ships[0].body
+        x, y = body.GetPosition().tuple()
+        linear_velocity_x, linear_velocity_y = body.GetLinearVelocity().tuple()
+        self.ship_observations[i] = (x, y, body.GetAngle(), linear_velocity_x,
+                                     linear_velocity_y,
+                                     body.GetAngularVelocity())
+        values = []
+        extend = values.extend
+        asteroids = islice((a for a in level.challenge.asteroids
+                            if not a.deleted),
+                           self.asteroid_observations.shape[1])
+        for asteroid in asteroids:
+            body = asteroid.body
+            extend(body.GetPosition().tuple())
+            extend(body.GetLinearVelocity().tuple())
+            values.append(asteroid.radius)
+        asteroid_count = len(values) // 5
+        self.asteroid_observations[i, :asteroid_count].flat = values
+        self.asteroid_observations[i, asteroid_count:] = 0.
+        self.asteroid_mask[i, :asteroid_count] = True
+        self.asteroid_mask[i, asteroid_count:] = False
+
+# Named benchmark scenarios. Each one is run from its own seed.
+BENCH_SCENARIOS = [
+    ('asteroids-10', dict(asteroid_count=10)),
+    ('asteroids-100', dict(asteroid_count=100)),
+    ('asteroids-200', dict(asteroid_count=200)),
+    ('firing', dict(firing=True)),
+    ('two-player', dict(single=False, firing=True)),
+    ('debug-draw', dict(debug=True)),
+    ('two-player-atlas', dict(single=False, firing=True, atlas=True)),
+    ('particles', dict(asteroid_count=100, single=False, firing=True,
+                       particles=True)),
+    ('ships-24', dict(ships=24)),
+    ('compound-ships-24', dict(ships=24, compound_ships=True)),
+    ('missiles', dict(asteroid_count=100, single=False, firing=True,
+                      locking=True, battery='missile')),
+    ('lasers', dict(asteroid_count=100, single=False, firing=True,
+                    battery='laser')),
+]
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.
+    i = int(round(percentile / 100. * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+def get_time_stats(times, prefix):
+    """Summarize a list of durations, in milliseconds."""
+    if not times:
+        return {prefix + '_mean_ms': None, prefix + '_p99_ms': None,
+                prefix + '_max_ms': None}
+    sorted_times = sorted(times)
+    return {prefix + '_mean_ms': 1000. * sum(times) / len(times),
+            prefix + '_p99_ms': 1000. * get_percentile(sorted_times, 99.),
+            prefix + '_max_ms': 1000. * sorted_times[-1]}
+
+def run_scenario(name, steps=1200, seed=0, window=None, asteroid_count=10,
+                 single=True, firing=False, debug=False, atlas=False,
+                 particles=None, ships=0, compound_ships=False,
+                 battery='plasma', locking=False):
+    """Run a benchmark scenario and return its results.
+
+    Draw times are only measured if a window is given.
+    """
+    level = Level(debug=debug, headless=(window is None),
+                  asteroid_count=asteroid_count, atlas=atlas, seed=seed,
+                  particles=particles, compound_ships=compound_ships,
+                  battery=battery)
+    level.create_player_ships(single=single)
+
+    # Extra ships in a row above the player ships, holding their positions.
+    for i in xrange(ships):
+        ship = Ship(level=level, position=(4. * i - 2. * ships, 10.),
+                    group_index=PLAYER_1_GROUP, compound=compound_ships)
+        level.player_ships.append(ship)
+    for ship in level.player_ships:
+        ship.locking = locking
+        for cannon in ship.cannons:
+            cannon.firing = firing
+    step_times = []
+    draw_times = []
+    for i in xrange(steps):
+        start_time = default_timer()
+        level.step()
+        step_times.append(default_timer() - start_time)
+        if window is not None:
+            window.dispatch_events()
+            window.clear()
+            start_time = default_timer()
+            level.draw(window.width, window.height)
+            glFinish()
+            draw_times.append(default_timer() - start_time)
+            window.flip()
+    total_step_time = sum(step_times)
+    results = dict(name=name, seed=seed, steps=steps,
+                   things=len(level.things),
+                   bodies=level.world.GetBodyCount(),
+                   pools=dict((cls.__name__, pool.get_stats())
+                              for cls, pool in level.pools.iteritems()),
+                   particles=(len(level.particles)
+                              if level.particles is not None else 0),
+                   steps_per_sec=steps / max(total_step_time, 1e-9),
+                   step_budget=total_step_time / steps / level.dt)
+    results.update(get_time_stats(step_times, 'step'))
+    results.update(get_time_stats(draw_times, 'draw'))
+    results.update(measure_snapshots(level))
+    return results
+
+def measure_snapshots(level, count=20, rollback_steps=10):
+    """Time saving snapshots of a level, and rolling back to them after a
+    few steps."""
+    save_times = []
+    load_times = []
+    for i in xrange(count):
+        start_time = default_timer()
+        snapshot = level.save_snapshot()
+        save_times.append(default_timer() - start_time)
+        for j in xrange(rollback_steps):
+            level.step()
+        start_time = default_timer()
+        level.load_snapshot(snapshot)
+        load_times.append(default_timer() - start_time)
+    results = dict(snapshot_bytes=len(snapshot))
+    results.update(get_time_stats(save_times, 'snapshot'))
+    results.update(get_time_stats(load_times, 'restore'))
+    return results
+
+def run_bench(names=None, steps=1200, seed=0, draw=True):
+    """Run the named benchmark scenarios, or all of them."""
+    window = None
+    if draw:
+        window = pyglet.window.Window(width=800, height=600, visible=False)
+        rabbyt.set_default_attribs()
+        glClearColor(0., 0., 0., 1.)
+    try:
+        results = []
+        for name, options in BENCH_SCENARIOS:
+            if names is None or name in names:
+                results.append(run_scenario(name, steps=steps, seed=seed,
+                                            window=window, **options))
+        return results
+    finally:
+        if window is not None:
+            window.close()
+
+def get_option(args, name, default=None):
+    """Get the value that follows an option, or the default value."""
+    if name in args:
+        i = args.index(name)
+        if i + 1 < len(args):
+            return args[i + 1]
+    return default
+
 def help():
     print """
 Usage: burst [OPTION]...
@@ -665,11 +4230,50 @@ Usage: burst [OPTION]...
 Options:
   -1            Enable single-player mode (default).
   -2            Enable two-player mode.
+  --asteroids N Number of asteroids in batch rounds (default 10).
+  --atlas       Pack sprite textures into an atlas and draw them in batches.
+  --batch N     Run N rounds of a scripted ship against an asteroid field
+                in a pool of processes, write the results of each round as
+                a JSON line, summarize them and exit.
+  --batch-output FILE
+                Write batch results to FILE (default burst-batch.jsonl).
+  --battery NAME
+                Arm ships with the named battery of cannons: plasma
+                (default), missile or laser.
+  --bench       Run benchmark scenarios, write the results as JSON and exit.
+  --bench-output FILE
+                Write benchmark results to FILE (default burst-bench.json).
+  --compound    Mount the cannons of ships as shapes on their hulls, instead
+                of jointing them to the hulls as bodies of their own.
+  --connect HOST:PORT
+                Fly the second ship of a game served at HOST:PORT.
   --debug       Enable debug graphics.
   --fps         Enable FPS counter.
+  --full-quality
+                Never lower the simulation quality when frames run over
+                budget. Recording implies this.
   --fullscreen  Enable fullscreen mode (default).
+  --headless    Run the simulation without graphics and exit. With --bench,
+                skip draw times. With --serve or --connect, run a server or
+                a firing client for the given number of steps.
   -h, --help    Print this helpful text and exit.
+  --scenario NAME
+                Only run the named benchmark scenario (use with --bench).
+  --serve PORT  Serve a two-player game on UDP port PORT, where the second
+                ship is flown by a client.
+  --seed N      Seed the random number generator (use with --headless or
+                --bench).
+  --steps N     Number of steps to run (use with --headless or --bench),
+                or the most steps of a batch round.
+  --processes N Number of processes for --batch (default: one per CPU).
+  --record FILE
+                Record the seed and the input of every step to FILE.
+  --replay FILE
+                Replay a recording headlessly, as fast as possible, check that
+                it ends up the same and exit.
   --test        Run tests and exit.
+  --threaded    Step the simulation on its own thread, and interpolate
+                between steps when drawing.
   -v            Enable verbose output (use with --test).
   --windowed    Enable windowed mode.
 
@@ -679,6 +4283,7 @@ Controls:
   Enter         Toggle target locking.
 
   Escape        Exit.
+  F3            Toggle timing overlay.
   F11           Toggle fullscreen mode.
   F12           Save a screenshot.
 """.strip()
@@ -687,14 +4292,132 @@ def test():
     import doctest
     doctest.testmod()
 
+def parse_address(address):
+    """Parse an address of the form HOST:PORT."""
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def headless(args, single=True):
+    steps = int(get_option(args, '--steps', 3600))
+    seed = get_option(args, '--seed')
+    if seed is not None:
+        seed = int(seed)
+    if '--serve' in args:
+        server = run_server(int(get_option(args, '--serve')), steps,
+                            seed=seed)
+        print 'Server: %d updates, %d bytes sent, %d bytes received, %s' % \
+            (server.seq, server.stats.bytes_sent,
+             server.stats.bytes_received, server.stats.format())
+        return
+    if '--connect' in args:
+        client = run_client(parse_address(get_option(args, '--connect')),
+                            steps * Level.dt)
+        state = client.states.get(client.ack, {})
+        print 'Client: %d updates, %d bytes sent, %d bytes received, ' \
+            '%d things, %s' % (client.ack, client.stats.bytes_sent,
+                               client.stats.bytes_received, len(state),
+                               client.stats.format())
+        return
+    level, elapsed = run_headless(steps, single=single, seed=seed)
+    print '%d steps in %.3f s (%.1f steps/s, %d things)' % \
+        (steps, elapsed, steps / max(elapsed, 1e-9), len(level.things))
+
+def replay(args):
+    filename = get_option(args, '--replay')
+    level, elapsed, same = run_replay(filename)
+    steps = int(level.time / level.dt + 0.5)
+    print '%d steps in %.3f s (%.1f steps/s, %d things)' % \
+        (steps, elapsed, steps / max(elapsed, 1e-9), len(level.things))
+    print 'Final state %s the recording.' % \
+        ('matches' if same else 'DIFFERS FROM')
+    if not same:
+        sys.exit(1)
+
+def batch(args):
+    rounds = int(get_option(args, '--batch', 100))
+    steps = int(get_option(args, '--steps', 7200))
+    seed = int(get_option(args, '--seed', 0))
+    asteroid_count = int(get_option(args, '--asteroids', 10))
+    processes = get_option(args, '--processes')
+    if processes is not None:
+        processes = int(processes)
+    output = get_option(args, '--batch-output', 'burst-batch.jsonl')
+    results = []
+    start_time = default_timer()
+    with open(output, 'w') as f:
+        for result in run_batch(rounds, seed=seed, max_steps=steps,
+                                asteroid_count=asteroid_count,
+                                processes=processes,
+                                compound_ships=('--compound' in args)):
+            results.append(result)
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+            f.flush()
+            print '%5d/%d  seed %-6d %s %6.1f s  %4d shots  %3d asteroids' % \
+                (len(results), rounds, result['seed'],
+                 'survived' if result['survived'] else 'hit at  ',
+                 result['survival_time'], result['shots_fired'],
+                 result['asteroids_destroyed'])
+    summary = summarize_rounds(results, default_timer() - start_time)
+    print ('%d rounds in %.1f s (%.2f rounds/s, %.0f steps/s): '
+           '%.0f%% survived, %.1f s mean survival, %.1f shots and '
+           '%.1f asteroids per round' %
+           (summary['rounds'], summary['elapsed'],
+            summary['rounds_per_sec'], summary['steps_per_sec'],
+            100. * summary['survival_rate'], summary['survival_time_mean'],
+            summary['shots_fired_mean'],
+            summary['asteroids_destroyed_mean']))
+
+def bench(args):
+    names = None
+    if '--scenario' in args:
+        names = [get_option(args[i:], '--scenario')
+                 for i, arg in enumerate(args) if arg == '--scenario']
+    steps = int(get_option(args, '--steps', 1200))
+    seed = int(get_option(args, '--seed', 0))
+    output = get_option(args, '--bench-output', 'burst-bench.json')
+    results = run_bench(names=names, steps=steps, seed=seed,
+                        draw=('--headless' not in args))
+    for result in results:
+        print '%-16s %9.1f steps/s  step %6.2f ms (p99 %6.2f ms, %3.0f%% ' \
+            'of dt)' % (result['name'], result['steps_per_sec'],
+                       result['step_mean_ms'], result['step_p99_ms'],
+                       100. * result['step_budget']),
+        if result['draw_mean_ms'] is not None:
+            print ' draw %6.2f ms (p99 %6.2f ms)' % (result['draw_mean_ms'],
+                                                     result['draw_p99_ms']),
+        print ' snapshot %5.2f ms, restore %5.2f ms (%d bytes)' % \
+            (result['snapshot_mean_ms'], result['restore_mean_ms'],
+             result['snapshot_bytes'])
+    with open(output, 'w') as f:
+        json.dump(dict(dt=Level.dt, scenarios=results), f, indent=2,
+                  sort_keys=True)
+
 def main():
     args = sys.argv[1:]
     if '-h' in args or '--help' in args:
         return help()
     if '--test' in args:
         return test()
+    if '--bench' in args:
+        return bench(args)
+    if '--replay' in args:
+        return replay(args)
+    if '--batch' in args:
+        return batch(args)
     debug = '--debug' in args
     fps = '--fps' in args
+    atlas = '--atlas' in args
+    threaded = '--threaded' in args
+    governed = '--full-quality' not in args
+    compound = '--compound' in args
+    battery = get_option(args, '--battery', 'plasma')
+    record = get_option(args, '--record')
+    serve = get_option(args, '--serve')
+    if serve is not None:
+        serve = int(serve)
+    connect = get_option(args, '--connect')
+    if connect is not None:
+        connect = parse_address(connect)
     single = True
     fullscreen = True
     for arg in args:
@@ -706,9 +4429,14 @@ def main():
             fullscreen = True
         if arg == '--windowed':
             fullscreen = False
+    if '--headless' in args:
+        return headless(args, single=single)
     two = '-2' in args or '--two' in args
     window = MyWindow(debug=debug, fps=fps, fullscreen=fullscreen,
-                      single=single)
+                      single=single, atlas=atlas, threaded=threaded,
+                      record=record, serve=serve, connect=connect,
+                      governed=governed, compound=compound,
+                      battery=battery)
     pyglet.app.run()
 
 if __name__ == '__main__':